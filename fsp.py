@@ -1,7 +1,6 @@
 import scipy.sparse as sp
 import numpy as np
 from scipy.integrate import solve_ivp
-from bidict import bidict
 import simulation
 from typing import Tuple, Union
 import collections.abc as abc
@@ -16,7 +15,8 @@ class StateSpaceEnumeration:
     """
     def __init__(self, cr: int, dim: int):     
         # we choose to always start at cl=0
-        self.bijection = bidict()
+        # states of the truncated state space, the n-th state being the one whose projection is lb+n
+        self.states = None
         self.dim = dim
         self.cl = np.zeros(self.dim, dtype=int)
         self.cr = np.zeros(self.dim, dtype=int)
@@ -66,16 +66,159 @@ class StateSpaceEnumeration:
             z11 = self.phi_inverse(z1, n-1)
             return z11 + (z2,)
     
-    def create_bijection(self):
-        r"""Saves the bijection values in a dictionary.
+    def indices(self, states: np.ndarray) -> np.ndarray:
+        r"""Computes the projections :math:`\Phi_{\text{dim}}` of several states at once.
+
+        Args:
+            - **states** (np.ndarray): States. Has shape :math:`(n, \text{dim})`.
+
+        Returns:
+            - The projection of each state, or :math:`-1` for the states which are not in the truncated state space. Has shape :math:`(n,)`.
+        """
+        states = np.asarray(states).astype(np.int64)
+        z = states[:, 0].copy()
+        for i in range(1, self.dim):
+            # closed form of the 2-dimensional projection
+            s = z + states[:, i]
+            z = s*(s+1)//2 + states[:, i]
+        outside = (states < 0).any(axis=1) | (z < self.lb) | (z > self.ub)
+        z[outside] = -1
+        return z
+
+    def inverses(self, z: np.ndarray) -> np.ndarray:
+        r"""Computes the inversed projections :math:`\Phi_{\text{dim}}^{-1}` of several integers at once.
 
-        A dictionary requires unhashable keys. For this reason, we use tuples instead of arrays.
+        Args:
+            - **z** (np.ndarray): Integers. Has shape :math:`(n,)`.
+
+        Returns:
+            - The corresponding states. Has shape :math:`(n, \text{dim})`.
+        """
+        z = np.asarray(z).astype(np.int64)
+        states = np.zeros((len(z), self.dim), dtype=np.int64)
+        for i in range(self.dim-1, 0, -1):
+            # closed form of the 2-dimensional inversed projection, corrected for rounding errors
+            v = np.floor((np.sqrt(8*z+1)-1)/2).astype(np.int64)
+            v[v*(v+1)//2 > z] -= 1
+            v[(v+1)*(v+2)//2 <= z] += 1
+            states[:, i] = z - v*(v+1)//2
+            z = v - states[:, i]
+        states[:, 0] = z
+        return states
+
+    def create_bijection(self):
+        r"""Computes the states of the truncated state space, saved in the attribute **states** as an array of shape 
+        :math:`(N_{\max}, \text{dim})`. The index of a state in this array is given by the function ``indices``.
         """        
-        self.bijection[self.lb] = tuple(self.cl)
-        self.bijection[self.ub] = tuple(self.cr)
-        for z in range(self.lb, self.ub):
-            self.bijection[z] = self.phi_inverse(z, self.dim)
-        # print(self.bijection)
+        self.states = self.inverses(np.arange(self.lb, self.ub+1))
+
+    def expand(self, factor: float =2):
+        r"""Computes a larger truncated state space which contains the current one.
+
+        Args:
+            - **factor** (float, optional): Factor by which :math:`C_r` is multiplied. Defaults to :math:`2`.
+        """
+        truncation = StateSpaceEnumeration(int(np.ceil(factor*self.cr[-1])), self.dim)
+        truncation.create_bijection()
+        return truncation
+
+
+class RectangularTruncation:
+    r"""Truncation of the state space to the states whose abundances are lower than an upper bound for each species.
+    The states are enumerated in the order of ``np.ravel_multi_index``.
+
+    Args:
+        - **bounds** (np.ndarray): Maximal abundance of each species. Has shape :math:`(N,)`.
+    """
+    def __init__(self, bounds: np.ndarray):
+        self.bounds = np.asarray(bounds).astype(np.int64)
+        self.dim = len(self.bounds)
+        self.shape = tuple(self.bounds + 1)
+        self.n_states = int(np.prod(self.shape))
+        self.states = np.stack(np.unravel_index(np.arange(self.n_states), self.shape), axis=1)
+
+    def indices(self, states: np.ndarray) -> np.ndarray:
+        r"""Computes the indices of several states at once.
+
+        Args:
+            - **states** (np.ndarray): States. Has shape :math:`(n, N)`.
+
+        Returns:
+            - The index of each state, or :math:`-1` for the states which are not in the truncated state space. Has shape :math:`(n,)`.
+        """
+        states = np.asarray(states).astype(np.int64)
+        inside = ((states >= 0) & (states <= self.bounds)).all(axis=1)
+        z = np.full(len(states), -1, dtype=np.int64)
+        z[inside] = np.ravel_multi_index(tuple(states[inside].T), self.shape)
+        return z
+
+    def expand(self, factor: float =2):
+        r"""Computes a larger truncated state space which contains the current one.
+
+        Args:
+            - **factor** (float, optional): Factor by which the bounds are multiplied. Defaults to :math:`2`.
+        """
+        return RectangularTruncation(np.ceil(factor*np.maximum(self.bounds, 1)))
+
+
+class ReachableTruncation:
+    r"""Truncation of the state space to an arbitrary set of states, for instance the states reachable from the initial state.
+    The indices are found in a lookup array covering the smallest box which contains all the states.
+
+    Args:
+        - **states** (np.ndarray): States of the truncated state space. Has shape :math:`(N_{\max}, N)`.
+    """
+    def __init__(self, states: np.ndarray):
+        states = np.asarray(states).astype(np.int64)
+        if (states < 0).any():
+            raise ValueError('Abundances should be nonnegative.')
+        self.states = np.unique(states, axis=0)
+        self.n_states, self.dim = self.states.shape
+        self._box = RectangularTruncation(self.states.max(axis=0))
+        self._lookup = np.full(self._box.n_states, -1, dtype=np.int64)
+        self._lookup[self._box.indices(self.states)] = np.arange(self.n_states)
+
+    @classmethod
+    def from_crn(cls, crn: simulation.CRN, bounds: np.ndarray, params: np.ndarray =None):
+        r"""Computes the states which can be reached from the initial state of a CRN without exceeding the bounds.
+
+        Args:
+            - **crn** (simulation.CRN): CRN to work on.
+            - **bounds** (np.ndarray): Maximal abundance of each species. Has shape :math:`(N,)`.
+            - **params** (np.ndarray, optional): Parameters of the propensity functions. If specified, a reaction can only occur 
+              from the states where its propensity is positive. If None, only the stoichiometry is considered. Defaults to None.
+        """
+        box = RectangularTruncation(bounds)
+        jumps = np.asarray(crn.stoichiometry_mat).astype(np.int64).T
+        reached = np.zeros(box.n_states, dtype=bool)
+        frontier = np.asarray(crn.init_state).astype(np.int64)[None, :]
+        reached[box.indices(frontier)] = True
+        while len(frontier) > 0:
+            # breadth-first search, one step of all reactions from all states of the frontier at once
+            possible = np.ones((len(frontier), len(jumps)), dtype=bool)
+            if params is not None:
+                possible = crn.vectorized_propensities(params, frontier) > 0
+            new_states = (frontier[:, None, :] + jumps[None, :, :])[possible]
+            z = np.unique(box.indices(new_states))
+            z = z[(z >= 0)]
+            z = z[~reached[z]]
+            reached[z] = True
+            frontier = box.states[z]
+        return cls(box.states[reached])
+
+    def indices(self, states: np.ndarray) -> np.ndarray:
+        r"""Computes the indices of several states at once.
+
+        Args:
+            - **states** (np.ndarray): States. Has shape :math:`(n, N)`.
+
+        Returns:
+            - The index of each state, or :math:`-1` for the states which are not in the truncated state space. Has shape :math:`(n,)`.
+        """
+        z = self._box.indices(states)
+        inside = z >= 0
+        z[inside] = self._lookup[z[inside]]
+        return z
 
 
 class SensitivitiesDerivation:
@@ -92,12 +235,33 @@ class SensitivitiesDerivation:
           The values of `index` thus are in :math:`[\![1, M_{\theta}+M_{\xi}]\!]`. Defaults to None.
         - :math:`C_r` (int, optional): Value such that :math:`(0, .., 0, C_r)` is the last value in the truncated space. 
           Defaults to :math:`50`.
+        - **truncation** (Union[StateSpaceEnumeration, RectangularTruncation, ReachableTruncation], optional): Truncated state space. 
+          If None, the states are enumerated by ``StateSpaceEnumeration`` up to :math:`C_r`. Otherwise, :math:`C_r` is ignored. 
+          The states of a ``StateSpaceEnumeration`` are computed by ``create_bijection`` if they were not yet. Defaults to None.
+        - **tol** (float, optional): Tolerance on the probability mass which leaves the truncated state space until the final time 
+          :math:`t_L`. If specified, it is shared between the time windows in proportion to their durations: the truncated state space
+          is expanded whenever more mass than :math:`\text{tol} \times t_j/t_L` has left it at the end of the time window 
+          :math:`[t_{j-1}, t_j]`, and the time window is solved again. The state space is set back to the initial one by ``reset``, 
+          such that each set of parameters only uses the states it reaches. Requires a truncation with an ``expand`` method. 
+          If None, the truncated state space is fixed. Defaults to None.
+        - **max_expansions** (int, optional): Maximal number of expansions of the truncated state space since the last reset, 
+          when **tol** is specified. Defaults to :math:`10`.
+
+    After each computation, the attribute **error_bounds** contains the probability mass which left the truncated state space 
+    :math:`1 - \sum_\ell \hat{p}_\ell(t)` at each sampling time. It bounds the :math:`\ell_1` error of the truncated 
+    probability mass function :cite:`munsky2006finite`.
 
     To simplify the notations in the following, we will omit the writing of parameters :math:`\xi`. This amounts to
     considering :math:`[\theta_1, ..., \theta_{M_{\theta}}, \xi_1^1, \xi_1^2, ..., \xi_1^{M_{\xi}}, ..., \xi_L^{M_{\xi}}] = [\theta_1, ..., \theta_{M'}]`.
     """
-    def __init__(self, crn: simulation.CRN, n_time_windows: int, index: Tuple[list, int], cr: int =50):     
-        self.cr = cr
+    def __init__(self, 
+                crn: simulation.CRN, 
+                n_time_windows: int, 
+                index: Tuple[list, int], 
+                cr: int =50,
+                truncation: Union[StateSpaceEnumeration, RectangularTruncation, ReachableTruncation] =None,
+                tol: float =None,
+                max_expansions: int =10):     
         self.crn = crn # make sure to specify propensities_drv if the CRN does not follow mass-action kinetics
         self.n_fixed_params = crn.n_fixed_params
         self.n_control_params = crn.n_control_params
@@ -106,10 +270,6 @@ class SensitivitiesDerivation:
         self.n_time_windows = n_time_windows
         self.n_reactions = crn.n_reactions
         self.n_species = crn.n_species
-        self.bijection = StateSpaceEnumeration(cr, dim=self.n_species)
-        self.bijection.create_bijection()
-        self.entries = self.bijection.bijection.values()
-        self.n_states = len(self.entries)
         # parameters index to consider
         if index is None:
             self.index = np.arange(self.n_total_params)
@@ -124,128 +284,171 @@ class SensitivitiesDerivation:
             self.index = np.array(index)
             self.index = np.concatenate([index[index < self.n_fixed_params]] + # fixed parameters
                                     [(index[index >= self.n_fixed_params]) + self.n_control_params*i for i in range(self.n_time_windows)]) # control parameters
+        if truncation is None:
+            truncation = StateSpaceEnumeration(cr, dim=self.n_species)
+        if tol is not None and (tol <= 0 or not hasattr(truncation, 'expand')):
+            raise ValueError('The tolerance should be positive and the truncated state space should be expandable.')
+        self.tol = tol
+        self.max_expansions = max_expansions
+        self.n_expansions = 0
+        self.initial_truncation = truncation
+        # larger truncated state space used when each truncated state space is expanded, and rate matrices of each truncated 
+        # state space in the case of mass-action kinetics, kept to be reused when the parameters change
+        self._expansions = {}
+        self._generator_bases = {}
+        self._constant_matrices = {}
+        self.set_truncation(truncation)
         self.time = 0
         self.current_time_window = 0
+        self.current_state = self.init_state.copy()
+        self.error_bounds = None
+
+    def set_truncation(self, truncation: Union[StateSpaceEnumeration, RectangularTruncation, ReachableTruncation]):
+        r"""Sets the truncated state space and computes the transitions between its states. The states of a ``StateSpaceEnumeration``
+        are computed first if ``create_bijection`` was not called.
+
+        Args:
+            - **truncation** (Union[StateSpaceEnumeration, RectangularTruncation, ReachableTruncation]): Truncated state space.
+        """
+        if truncation.states is None:
+            truncation.create_bijection()
+        self.truncation = truncation
+        # the n-th state has index n in the truncated state space, to evaluate the propensities on all states at once
+        self.states = truncation.states
+        self.n_states = len(self.states)
+        # largest abundance, which sets the length of the marginal distributions
+        self.cr = int(self.states.max())
+        # index of the state reached from each state by each reaction, -1 if it is outside the truncated state space
+        stoich_mat = np.asarray(self.crn.stoichiometry_mat).astype(np.int64)
+        self.targets = np.stack([truncation.indices(self.states + stoich_mat[:, k]) for k in range(self.n_reactions)], axis=1)
         # init_state has shape (n_states, len(index)+1)
         # first column corresponds to the probability distribution, 
         # (i+1)-th column corresponds to the sensitivities with respect to the i-th parameter distribution in the index list
         self.init_state = np.zeros((self.n_states, len(self.index)+1))
-        self.init_state[self.bijection.bijection.inverse[tuple(crn.init_state)], 0] = 1
-        self.current_state = self.init_state.copy()
+        init_index = truncation.indices(np.asarray(self.crn.init_state)[None, :])[0]
+        if init_index < 0:
+            raise ValueError('The initial state is not in the truncated state space.')
+        self.init_state[init_index, 0] = 1
+
+    def project(self, distributions: np.ndarray, states: np.ndarray) -> np.ndarray:
+        r"""Maps distributions computed on a smaller truncated state space onto the current one. 
+        The states which were not in the smaller truncated state space have zero probability and sensitivities.
+
+        Args:
+            - **distributions** (np.ndarray): Distributions on the smaller truncated state space. Has shape :math:`(n, ...)`.
+            - **states** (np.ndarray): States of the smaller truncated state space. Has shape :math:`(n, N)`.
+
+        Returns:
+            - The distributions on the current truncated state space. Has shape :math:`(N_{\max}, ...)`.
+        """
+        projection = np.zeros((self.n_states,) + distributions.shape[1:])
+        projection[self.truncation.indices(states)] = distributions
+        return projection
 
     def reset(self):
-        """Resets the class to the initial setting: sets the time to :math:`t=0`, the current time window to :math:`0`
-        and the current state to the initial state.
+        """Resets the class to the initial setting: sets the time to :math:`t=0`, the current time window to :math:`0`, 
+        the truncated state space to the initial one and the current state to the initial state.
         """        
+        if self.truncation is not self.initial_truncation:
+            self.set_truncation(self.initial_truncation)
+        self.n_expansions = 0
         self.time = 0
         self.current_time_window = 0
         self.current_state = self.init_state.copy()
 
     def create_generator(self, params: np.ndarray) -> np.ndarray:
-        r"""Computes the generator matrix :math:`\hat{A}^\theta` as defined in :cite:`fox2019fspfim`
+        r"""Computes the generator matrix :math:`\hat{A}^\theta` as defined in :cite:`fox2019fspfim`.
+        In the case of mass-action kinetics, :math:`\hat{A}^\theta = \sum_{k=1}^M \theta_k \hat{B}_k` is computed from the rate matrices
+        returned by ``generator_basis``, without evaluating the propensities.
 
         Args:
             - **params** (np.ndarray): Current parameters of the propensity functions.
 
         Returns:
-            - Generator :math:`\hat{A}^\theta` in the general case of non-mass-action kinetics.
+            - Generator :math:`\hat{A}^\theta`.
         """
-        Bs = []
-        # generator for each reaction
-        for index in range(self.n_reactions):
-            d = self.bijection.bijection.inverse
-            n = self.n_states
-            stoich_mat = self.crn.stoichiometry_mat[:,index]
-            propensity = self.crn.propensities[index]
-            # might contain negative elements
-            outputs = list(map(lambda entry: tuple(entry + stoich_mat), self.entries))
-            # propensity parameter is 1
-            data = np.array(list(map(lambda x: propensity(params, x), self.entries)))
-            columns = np.array([d[entry] for entry in self.entries])
-            get_index = lambda key: d[key] if key in d else -1
-            rows = np.array([get_index(output) for output in outputs])
-            compute_diags = np.vectorize(lambda i: -data[columns==i].sum())
-            diags = compute_diags(np.arange(n))
-            # truncation
-            mask = (rows >= 0) & (rows < n)
-            columns = columns[mask]
-            rows = rows[mask]
-            data = data[mask]
-            B = sp.coo_matrix((data, (rows, columns)), shape=(n, n))
-            B.setdiag(diags)
-            B.eliminate_zeros()
-            Bs.append(B)
-        return sum(Bs)
+        if self.crn.propensities_drv is None:
+            pattern, weights, _ = self.generator_basis()
+            return sp.csr_matrix((weights.dot(params[:self.n_reactions]), pattern.indices, pattern.indptr), shape=pattern.shape)
+        return self.assemble(self.crn.vectorized_propensities(params, self.states))
+
+    def generator_basis(self) -> Tuple[sp.csr_matrix, np.ndarray, list]:
+        r"""Computes the rate matrices :math:`\hat{B}_k` of each reaction at unit parameters, in the case of mass-action kinetics. 
+        They only depend on the truncated state space and are computed once for each truncated state space.
+
+        Returns:
+            - The sparsity pattern of :math:`\hat{A}^\theta` in CSR format. Has shape :math:`(N_{\max}, N_{\max})`.
+            - The values of each :math:`\hat{B}_k` on this sparsity pattern, such that the values of :math:`\hat{A}^\theta` are 
+              given by the product with :math:`\theta`. Has shape :math:`(\text{nnz}, M)`.
+            - The list of the matrices :math:`\hat{B}_k` in CSR format.
+        """
+        if self.truncation not in self._generator_bases:
+            rates = self.crn.vectorized_propensities(np.ones(self.n_params), self.states)
+            pattern = self.assemble(rates)
+            pattern.sort_indices()
+            # the entries are sorted by row and column in the CSR format
+            keys = np.repeat(np.arange(self.n_states, dtype=np.int64), np.diff(pattern.indptr))*self.n_states + pattern.indices
+            weights = np.zeros((pattern.nnz, self.n_reactions))
+            matrices = []
+            for k in range(self.n_reactions):
+                reaction_rates = np.zeros_like(rates)
+                reaction_rates[:, k] = rates[:, k]
+                matrix = self.assemble(reaction_rates)
+                coo = matrix.tocoo()
+                np.add.at(weights[:, k], np.searchsorted(keys, coo.row.astype(np.int64)*self.n_states + coo.col), coo.data)
+                matrices.append(matrix)
+            self._generator_bases[self.truncation] = (pattern, weights, matrices)
+        return self._generator_bases[self.truncation]
+
+    def assemble(self, rates: np.ndarray) -> sp.csr_matrix:
+        r"""Builds the matrix :math:`\sum_{k=1}^M \hat{B}_k` of the transitions of all reactions, the rate of the reaction :math:`k` 
+        from the :math:`n`-th state being given by **rates**. The diagonal contains the opposite of the total outflow rate of each state, 
+        including the transitions which leave the truncated state space, according to :cite:`fox2019fspfim`.
+
+        Args:
+            - **rates** (np.ndarray): Rates of each reaction for each state. Has shape :math:`(N_{\max}, M)`.
+
+        Returns:
+            - The matrix in CSR format. Has shape :math:`(N_{\max}, N_{\max})`.
+        """
+        n = self.n_states
+        # truncation
+        mask = self.targets >= 0
+        columns = np.broadcast_to(np.arange(n)[:, None], mask.shape)[mask]
+        rows = self.targets[mask]
+        data = rates[mask]
+        diag = np.arange(n)
+        matrix = sp.csr_matrix((np.concatenate((data, -rates.sum(axis=1))), 
+                                (np.concatenate((rows, diag)), np.concatenate((columns, diag)))), shape=(n, n))
+        matrix.eliminate_zeros()
+        return matrix
 
     def create_gdrv(self, params: np.ndarray, ind: int) -> np.ndarray:
         r"""Computes :math:`\frac{\partial \hat{A}^\theta}{\partial \theta_{\text{ind}}}` in the
         case of non-mass-action kinetics.
 
-        Requires the propensity derivatives to be explicitly defined.
+        Requires the propensity derivatives to be explicitly defined. Reactions whose propensity does not depend on
+        :math:`\theta_{\text{ind}}`, as given by ``crn.drv_sparsity``, are skipped.
 
         Args:
             - **params** (np.ndarray): Current parameters of the propensity functions.
             - **index** (int): Index of the parameter from which :math:`\hat{A}^\theta` is derived.
         """
-        dA = []
-        for index in range(self.n_reactions):
-            d = self.bijection.bijection.inverse
-            n = self.n_states
-            stoich_mat = self.crn.stoichiometry_mat[:,index]
-            propensity = self.crn.propensities_drv[index, ind]
-            # might contain negative elements
-            outputs = list(map(lambda entry: tuple(entry + stoich_mat), self.entries))
-            # propensity parameter is 1
-            data = np.array(list(map(lambda x: propensity(params, x), self.entries)))
-            columns = np.array([d[entry] for entry in self.entries])
-            get_index = lambda key: d[key] if key in d else -1
-            rows = np.array([get_index(output) for output in outputs])
-            compute_diags = np.vectorize(lambda i: -data[columns==i].sum())
-            diags = compute_diags(np.arange(n))
-            # truncation
-            mask = (rows >= 0) & (rows < n)
-            columns = columns[mask]
-            rows = rows[mask]
-            data = data[mask]
-            # according tox Fox and Munsky's paper
-            dAi = sp.coo_matrix((data, (rows, columns)), shape=(n, n))
-            dAi.setdiag(diags)
-            dAi.eliminate_zeros()
-            dA.append(dAi)
-        return sum(dA)
+        rates = np.zeros((self.n_states, self.n_reactions))
+        reactions = np.flatnonzero(self.crn.drv_sparsity[:, ind])
+        if len(reactions) > 0:
+            rates[:, reactions] = simulation.PropensityBundle(np.asarray(self.crn.propensities_drv)[reactions, ind])(params, self.states)
+        return self.assemble(rates)
 
     def create_gdrv_B(self, ind: int) -> np.ndarray:
         r"""Computes :math:`\frac{\partial \hat{A}^\theta}{\partial \theta_{\text{ind}}}` in the case of mass-action kinetics.
         In that case, :math:`\frac{\partial\hat{A}^\theta}{\partial \theta_{\text{ind}}} = \hat{B}_{\text{ind}}` 
-        where the rate matrix :math:`\hat{B}_i` is as defined in :cite:`fox2019fspfim`.
+        where the rate matrix :math:`\hat{B}_i` is as defined in :cite:`fox2019fspfim`. It is taken from ``generator_basis``.
 
         Args:
             - **ind** (int): Index of the parameter from which :math:`\hat{A}^\theta` is derived.
         """
-        d = self.bijection.bijection.inverse
-        n = self.n_states
-        stoich_mat = self.crn.stoichiometry_mat[:,ind]
-        propensity = self.crn.propensities[ind]
-        # might contain negative elements
-        outputs = list(map(lambda entry: tuple(entry + stoich_mat), self.entries))
-        # propensity parameter is 1
-        data = np.array(list(map(lambda x: propensity(np.ones(self.n_params), x), self.entries)))
-        #
-        columns = np.array([d[entry] for entry in self.entries])
-        get_index = lambda key: d[key] if key in d else -1
-        rows = np.array([get_index(output) for output in outputs])
-        compute_diags = np.vectorize(lambda i: -data[columns==i].sum())
-        diags = compute_diags(np.arange(n))
-        # truncation
-        mask = (rows >= 0) & (rows < n)
-        columns = columns[mask]
-        rows = rows[mask]
-        data = data[mask]
-        # according tox Fox and Munsky's paper
-        B = sp.coo_matrix((data, (rows, columns)), shape=(n, n))
-        B.setdiag(diags)
-        B.eliminate_zeros()
-        return B
+        return self.generator_basis()[2][ind]
 
 
     def create_generator_derivative(self, params: np.ndarray, ind: int) -> np.ndarray:
@@ -276,23 +479,55 @@ class SensitivitiesDerivation:
             \\ \vdots & \vdots & \vdots & \ddots & \vdots \\ 
             \frac{\partial \hat{A}^\theta}{\partial \theta_{i_\alpha}} & 0 & 0 & ... & \hat{A}^\theta \end{pmatrix}
 
+        In the case of mass-action kinetics, :math:`\hat{C}^\theta` is affine in :math:`\theta`. Its sparsity pattern and the 
+        values of each term are computed once for each truncated state space and each set of parameters acting on the current
+        time window, then :math:`\hat{C}^\theta` is formed by a single matrix-vector product.
+
         Args:
             - **params** (np.ndarray): Current parameters of the propensity functions. Has shape :math:`(M_{\theta} + M_{\xi},)`.
         """
-        n = len(self.index)
-        A = self.create_generator(params)
-        empty = sp.coo_matrix(A.shape)
-        rows = [sp.hstack([A]+[empty]*n)]
         current_params = self.n_fixed_params + self.current_time_window*self.n_control_params #
-        for i, ind in enumerate(self.index):
+        derivatives = []
+        for ind in self.index:
             if ind >= self.n_fixed_params and (current_params > ind or current_params + self.n_control_params <= ind):
                 # the parameter n°ind has no action on the current time window
-                B = sp.coo_matrix(A.shape)
+                derivatives.append(None)
             else:
                 if ind > self.n_fixed_params:
                     # the parameter n°ind is controlled and is the one used on the current time window
                     ind = ind - self.current_time_window*self.n_control_params
-                B = self.create_generator_derivative(params, ind)
+                derivatives.append(ind)
+        if self.crn.propensities_drv is not None:
+            return self.stack(self.create_generator(params), 
+                              [None if ind is None else self.create_generator_derivative(params, ind) for ind in derivatives])
+        key = (self.truncation, tuple(derivatives))
+        if key not in self._constant_matrices:
+            pattern, weights, matrices = self.generator_basis()
+            def with_values(matrix, values):
+                return sp.csr_matrix((values, matrix.indices, matrix.indptr), shape=matrix.shape)
+            # every term is stacked with the same sparsity pattern, keeping explicit zeros, so that their values are aligned
+            constant = self.stack(with_values(pattern, np.zeros(pattern.nnz)), 
+                                  [None if ind is None else matrices[ind] for ind in derivatives]).tocsr()
+            zeros = [None if ind is None else with_values(matrices[ind], np.zeros(matrices[ind].nnz)) for ind in derivatives]
+            terms = np.stack([self.stack(with_values(pattern, weights[:, k]), zeros).tocsr().data for k in range(self.n_reactions)], axis=1)
+            self._constant_matrices[key] = (constant, terms)
+        constant, terms = self._constant_matrices[key]
+        return sp.csr_matrix((terms.dot(params[:self.n_reactions]) + constant.data, constant.indices, constant.indptr), shape=constant.shape)
+
+    def stack(self, A: sp.csr_matrix, derivatives: list) -> sp.coo_matrix:
+        r"""Builds the constant matrix :math:`\hat{C}^\theta` from the generator and its derivatives, as defined in ``constant_matrix``.
+
+        Args:
+            - **A** (sp.csr_matrix): Generator :math:`\hat{A}^\theta`. Has shape :math:`(N_{\max}, N_{\max})`.
+            - **derivatives** (list): Derivative of the generator with respect to each parameter in `index`, or None when the 
+              parameter has no action on the current time window.
+        """
+        n = len(derivatives)
+        empty = sp.coo_matrix(A.shape)
+        rows = [sp.hstack([A]+[empty]*n)]
+        for i, B in enumerate(derivatives):
+            if B is None:
+                B = sp.coo_matrix(A.shape)
             row = sp.hstack([B] + [empty]*i + [A] + [empty]*(n-i-1))
             rows.append(row)
         return sp.vstack(rows)
@@ -342,6 +577,39 @@ class SensitivitiesDerivation:
 
 
         
+    def solve_time_window(self, t: float, params: np.ndarray, t_eval: np.ndarray, with_stv: bool) -> np.ndarray:
+        r"""Solves the set of ODEs from the current time and current state until time :math:`t`.
+
+        Args:
+            - :math:`t` (float): Final time of the time window.
+            - **params** (np.ndarray): Parameters of the propensity functions. Has shape :math:`(M_{\theta}+M_{\xi},)`.
+            - **t_eval** (np.ndarray): Sampling times.
+            - **with_stv** (bool): If True, computes the sensitivities of the likelihood with respect to the indices in `self.index`.
+
+        Returns:
+            - The probability and, if **with_stv** is True, the sensitivity distributions for each sampling time.
+              Has shape :math:`(N_{\max}, \text{len}(\text{t_eval}), \text{len}(\text{index})+1)` if **with_stv** is True 
+              and :math:`(N_{\max}, \text{len}(\text{t_eval}), 1)` otherwise.
+        """
+        if with_stv:
+            # computes the sensitivity of the likelihood for all fixed reactions
+            solution = self.solve_ode(init_state=self.current_state.reshape(self.n_states*(len(self.index)+1), order='F'),
+                                    t0=self.time,
+                                    tf=t, 
+                                    params=params,
+                                    t_eval=t_eval,
+                                    with_stv=True)['y']
+            # reshaping the array
+            solution = solution.reshape((self.n_states, len(self.index)+1, len(t_eval)), order='F')
+            return solution.transpose([0, 2, 1])
+        solution = self.solve_ode(init_state=self.current_state[:,0], 
+                                t0=self.time,
+                                tf=t, 
+                                params=params,
+                                t_eval=t_eval,
+                                with_stv=False)['y']
+        return np.expand_dims(solution, axis=-1)
+        
     def solve_multiple_odes(self,
                             sampling_times: np.ndarray,
                             time_windows: np.ndarray,
@@ -381,32 +649,34 @@ class SensitivitiesDerivation:
                 # to get state at time t to update the current state
                 t_eval = np.concatenate((t_eval, [t]))
                 added_t = -1
+            solution = self.solve_time_window(t, params, t_eval, with_stv)
+            # the mass lost in the previous time windows is below the tolerance up to their final time, which leaves
+            # a positive tolerance for the current time window
+            while self.tol is not None and 1 - solution[:, -1, 0].sum() > self.tol * t / time_windows[-1]:
+                # too much probability mass has left the truncated state space, the time window is solved again on a larger one
+                if self.n_expansions >= self.max_expansions:
+                    raise ValueError(f'The truncated state space has been expanded {self.n_expansions} times and still loses more '
+                                     f'probability mass than the tolerance at time {t}. Increase max_expansions or tol.')
+                self.n_expansions += 1
+                states = self.states
+                if self.truncation not in self._expansions:
+                    self._expansions[self.truncation] = self.truncation.expand()
+                self.set_truncation(self._expansions[self.truncation])
+                self.current_state = self.project(self.current_state, states)
+                distributions = [self.project(distribution, states) for distribution in distributions]
+                solution = self.solve_time_window(t, params, t_eval, with_stv)
+            distributions.append(solution[:, :added_t, :]) # shape (n_states, L, 1) or (n_states, L, len(index)+1)
             if with_stv:
-                # computes the sensitivity of the likelihood for all fixed reactions
-                solution = self.solve_ode(init_state=self.current_state.reshape(self.n_states*(len(self.index)+1), order='F'),
-                                        t0=self.time,
-                                        tf=t, 
-                                        params=params,
-                                        t_eval=t_eval,
-                                        with_stv=True)['y']
-                # reshaping the array
-                solution = solution.reshape((self.n_states, len(self.index)+1, len(t_eval)), order='F')
-                distributions.append(solution.transpose([0, 2, 1])[:,:added_t,:]) # shape (n_states, L, len(index)+1)
-                self.current_state = solution[:,:,-1]
+                self.current_state = solution[:, -1, :]
             else:
-                solution = self.solve_ode(init_state=self.current_state[:,0], 
-                                        t0=self.time,
-                                        tf=t, 
-                                        params=params,
-                                        t_eval=t_eval,
-                                        with_stv=False)['y']
-                distributions.append(np.expand_dims(solution[:, :added_t], axis=-1)) # shape (n_states, L, 1)
-                self.current_state[:,0] = solution[:,-1]
+                self.current_state[:, 0] = solution[:, -1, 0]
             self.time = t
             self.current_time_window += 1
             if (sampling_times[-1] <= t): # all samples have been collected
                 break
-        return np.concatenate(distributions, axis=1) # shape (n_states, L, 1) or (n_states, L, len(index)+1)
+        distributions = np.concatenate(distributions, axis=1) # shape (n_states, L, 1) or (n_states, L, len(index)+1)
+        self.error_bounds = 1 - distributions[:, :, 0].sum(axis=0)
+        return distributions
 
 
     def marginal(self,  
@@ -432,14 +702,13 @@ class SensitivitiesDerivation:
             - The marginal probability and, if **with_stv** is True, the marginal sensitivities of the likelihood for each sampling time.
               Has shape :math:`(N_{\max}, L, \text{len}(\text{index})+1)` if **with_stv** is True and :math:`(N_{\max}, L, 1)` otherwise.
         """
+        solution = self.solve_multiple_odes(sampling_times, time_windows, parameters, with_stv)
+        # allocated after solving, as the truncated state space may have been expanded
         if with_stv:
             marginal_distributions = np.zeros((self.cr+1, len(sampling_times), len(self.index)+1))
         else:
             marginal_distributions = np.zeros((self.cr+1, len(sampling_times), 1))
-        solution = self.solve_multiple_odes(sampling_times, time_windows, parameters, with_stv)
-        for n, state in self.bijection.bijection.items():
-            for i, _ in enumerate(sampling_times):
-                marginal_distributions[state[ind_species],i,:] += solution[n,i,:]
+        np.add.at(marginal_distributions, self.states[:, ind_species], solution)
         return marginal_distributions # shape (n_states, L, 1) or (n_states, L, len(index)+1)
 
     def marginals(self, 
@@ -495,7 +764,7 @@ class SensitivitiesDerivation:
                                                 ind_species=ind_species,
                                                 with_stv=False)[:,:,0]
         self.reset()
-        return np.dot(marginal_distributions.transpose(), np.arange(self.cr+1)) # shape(L,)
+        return np.dot(marginal_distributions.transpose(), np.arange(len(marginal_distributions))) # shape(L,)
 
     def gradient_expected_val(self, 
                             sampling_times: np.ndarray, 
@@ -525,7 +794,7 @@ class SensitivitiesDerivation:
                                                 with_stv=True)
         self.reset()
         stv = marginal_distributions[:, :, 1:]
-        x = np.arange(self.cr + 1)
+        x = np.arange(len(marginal_distributions))
         expect = np.dot(marginal_distributions[:, :, 0].transpose(), x)
         grad_expect = np.dot(np.transpose(stv, [1, 2, 0]), x)
         if with_probs:
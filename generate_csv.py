@@ -2,7 +2,7 @@ import simulation
 import generate_data
 import convert_csv
 import numpy as np
-from typing import Tuple
+from typing import Tuple, Union
 
 def generate_csv_datasets(crn_name: str,
                           datasets: dict,
@@ -12,12 +12,15 @@ def generate_csv_datasets(crn_name: str,
                           propensities: np.ndarray,
                           time_windows: np.ndarray,
                           sampling_times: np.ndarray,
-                          ind_species: int,
+                          ind_species: Union[int, list],
                           n_trajectories: int,
                           sobol_start: np.ndarray,
                           sobol_end: np.ndarray,
                           initial_state: Tuple[bool, np.ndarray] =(False, None),
-                          method: str ='SSA'):
+                          method: str ='SSA',
+                          seed: int =None,
+                          max_abundances: np.ndarray =None,
+                          max_events: int =None):
     r"""Generates datasets from Stochastic Simulations and saves them in CSV files.
 
     Args:
@@ -32,13 +35,24 @@ def generate_csv_datasets(crn_name: str,
           such that the time windows are :math:`[0, t_1], [t_1, t_2], ..., [t_{L-1}, t_L]`. :math:`t_L` must match
           with the final time :math:`t_f`. If there is only one time window, it should be defined as :math:`[t_f]`.
         - **sampling_times** (np.ndarray): Sampling times.
-        - **ind_species** (int): Index of the species of interest.
+        - **ind_species** (Union[int, list]): Index of the species of interest. If it is a list of indices, one dataset is saved
+          for each species, all computed from the same simulations. The files names then include the index of the species,
+          as in `X_{crn_name}_species{ind_species}_{key}`.
         - :math:`n_{\text{trajectories}}` (int): Number of trajectories to compute to estimate the distribution for each set of parameters.
         - **sobol_start** (np.ndarray): Lower boundaries of the parameters samples. Has shape :math:`(M_{\text{tot}},)`.
         - **sobol_end** (np.ndarray): Upper boundaries of the parameters samples. Has shape :math:`(M_{\text{tot}},)`.
         - **initial_state** (Tuple[bool, np.ndarray], optional): Initial state of the species. Defaults to (False, None), which
           sets the initial state to :math:`0` for all species.
         - **method** (str): Stochastic Simulation to compute. Defaults to `SSA`.
+        - **seed** (int, optional): Seed of the random number generators. If None, fresh entropy is used. Defaults to None.
+        - **max_abundances** (np.ndarray, optional): Maximal abundance of each species. A trajectory whose abundances exceed it is 
+          stopped and its state remains the same until the final time. If None, no maximal abundance. Defaults to None.
+        - **max_events** (int, optional): Maximal number of events of a trajectory, after which it is stopped in the same way. 
+          If None, no maximal number of events. Defaults to None.
+
+    The number of stopped trajectories for each set of parameters is saved alongside the datasets, in the files 
+    `X_{crn_name}_{key}_n_capped`. Their :math:`i`-th row corresponds to the rows 
+    :math:`i\times\text{n_sampling_times}, ..., (i+1)\times\text{n_sampling_times}-1` of `X_{crn_name}_{key}`.
     """                         
     data_length = sum(datasets.values())
     n_times = len(sampling_times)
@@ -55,17 +69,26 @@ def generate_csv_datasets(crn_name: str,
                                         time_windows=time_windows,
                                         sampling_times=sampling_times, 
                                         ind_species=ind_species, 
-                                        method=method)
-    X, y = dataset.generate_data(data_length=data_length, 
+                                        method=method,
+                                        seed=seed,
+                                        max_abundances=max_abundances,
+                                        max_events=max_events)
+    data = dataset.generate_data(data_length=data_length, 
                                 n_trajectories=n_trajectories, 
                                 sobol_start=sobol_start, 
                                 sobol_end=sobol_end)
+    if dataset.several_species:
+        data = {f'{crn_name}_species{species}': Xy for species, Xy in data.items()}
+    else:
+        data = {crn_name: data}
     # writing CSV files
-    somme = 0
-    for key, value in datasets.items():
-        convert_csv.array_to_csv(X[n_times*somme:n_times*(somme+value),:], f'X_{crn_name}_{key}')
-        convert_csv.array_to_csv(y[n_times*somme:n_times*(somme+value),:], f'y_{crn_name}_{key}')
-        somme += value
+    for name, (X, y) in data.items():
+        somme = 0
+        for key, value in datasets.items():
+            convert_csv.array_to_csv(X[n_times*somme:n_times*(somme+value),:], f'X_{name}_{key}')
+            convert_csv.array_to_csv(y[n_times*somme:n_times*(somme+value),:], f'y_{name}_{key}')
+            convert_csv.array_to_csv(dataset.n_capped[somme:somme+value].reshape(-1, 1), f'X_{name}_{key}_n_capped')
+            somme += value
 
 
 def generate_csv_simulations(crn_name: str,
@@ -79,7 +102,8 @@ def generate_csv_simulations(crn_name: str,
                               n_trajectories: int,
                               params: np.ndarray,
                               initial_state: np.ndarray,
-                              method: str ='SSA'):
+                              method: str ='SSA',
+                              seed: int =None):
     r"""Generates simulations of the abundance evolution of a species from Stochastic Simulations
     and saves them in CSV files.
 
@@ -100,6 +124,15 @@ def generate_csv_simulations(crn_name: str,
         - **initial_state** (Tuple[bool, np.ndarray], optional): Initial state of the species. Defaults to (False, None), which
           sets the initial state to :math:`0` for all species.
         - **method** (str): Stochastic Simulation to compute. Defaults to `SSA`.
+        - **seed** (int, optional): Seed of the random number generators. If None, fresh entropy is used. Defaults to None.
+        - **max_abundances** (np.ndarray, optional): Maximal abundance of each species. A trajectory whose abundances exceed it is 
+          stopped and its state remains the same until the final time. If None, no maximal abundance. Defaults to None.
+        - **max_events** (int, optional): Maximal number of events of a trajectory, after which it is stopped in the same way. 
+          If None, no maximal number of events. Defaults to None.
+
+    The number of stopped trajectories for each set of parameters is saved alongside the datasets, in the files 
+    `X_{crn_name}_{key}_n_capped`. Their :math:`i`-th row corresponds to the rows 
+    :math:`i\times\text{n_sampling_times}, ..., (i+1)\times\text{n_sampling_times}-1` of `X_{crn_name}_{key}`.
     """
     crn = simulation.CRN(stoichiometry_mat=stoich_mat,
                         propensities=propensities, 
@@ -112,10 +145,11 @@ def generate_csv_simulations(crn_name: str,
                                             ind_species=ind_species,
                                             complete_trajectory=False,
                                             sampling_times=sampling_times, 
-                                            method=method)
-    samples, _ = dataset.run_simulations(params=params)
-    # writing CSV files
-    convert_csv.array_to_csv(samples, f'Distributions_{crn_name}')
+                                            method=method,
+                                            seed=seed)
+    # writing CSV files, chunk by chunk
+    for samples, _ in dataset.iter_simulations(params=params, batches=True):
+        convert_csv.array_to_csv(samples, f'Distributions_{crn_name}')
 
 
 # because we use multiprocessing
@@ -3,14 +3,208 @@ import math
 import scipy.stats.qmc as qmc
 import time
 import concurrent.futures
+import collections
+import os
 import simulation
 from tqdm import tqdm
 import matplotlib.pyplot as plt
-import seaborn
-import pandas as pd
 from typing import Tuple, Union
 
 
+class HistogramAccumulator:
+    r"""Streaming histograms of the abundance of a species at each sampling time. Samples are added 
+    batch by batch and are not stored, so that the memory used does not depend on the number of trajectories.
+
+    Args:
+        - **n_sampling_times** (int): Number of sampling times.
+    """
+    def __init__(self, n_sampling_times: int):
+        self.n_sampling_times = n_sampling_times
+        self._counts = np.zeros((1, n_sampling_times), dtype=np.int64)
+        self.n_samples = 0
+
+    def update(self, samples: np.ndarray):
+        r"""Adds the abundances of a batch of trajectories to the histograms.
+
+        Args:
+            - **samples** (np.ndarray): Abundances at the sampling times. Has shape :math:`(n, \text{n_sampling_times})`.
+        """
+        samples = np.asarray(samples).astype(np.int64)
+        n_values = len(self._counts)
+        max_value = int(samples.max(initial=0))
+        if max_value >= n_values:
+            # more rows than needed, to limit the number of reallocations
+            n_values = max(2*n_values, max_value + 1)
+            self._counts = np.concatenate((self._counts, np.zeros((n_values - len(self._counts), self.n_sampling_times), dtype=np.int64)))
+        # one bincount for all sampling times, the value v at time i being counted at index v*n_sampling_times + i
+        indices = samples*self.n_sampling_times + np.arange(self.n_sampling_times)
+        self._counts += np.bincount(indices.ravel(), minlength=n_values*self.n_sampling_times).reshape((n_values, self.n_sampling_times))
+        self.n_samples += len(samples)
+
+    def counts(self, n_values: int =None) -> np.ndarray:
+        r"""Returns the histograms.
+
+        Args:
+            - **n_values** (int, optional): Number of abundance values :math:`0, ..., n_{\text{values}}-1` to return. If None, 
+              up to the maximum value reached. Defaults to None.
+
+        Returns:
+            - Number of samples for each value at each sampling time. Has shape :math:`(n_{\text{values}}, \text{n_sampling_times})`.
+        """
+        if n_values is None:
+            n_values = int(np.flatnonzero(self._counts.any(axis=1)).max(initial=0)) + 1
+        counts = np.zeros((n_values, self.n_sampling_times), dtype=np.int64)
+        n = min(n_values, len(self._counts))
+        counts[:n] = self._counts[:n]
+        return counts
+
+    def quantiles(self, q: Union[float, list]) -> np.ndarray:
+        r"""Computes quantiles of the abundance at each sampling time from the histograms. They are exact for integer 
+        abundances and rounded down to the integer below otherwise.
+
+        Args:
+            - **q** (Union[float, list]): Probabilities of the quantiles, between 0 and 1.
+
+        Returns:
+            - Quantiles at each sampling time. Has shape :math:`(\text{n_quantiles}, \text{n_sampling_times})`, or 
+              :math:`(\text{n_sampling_times})` if **q** is a float.
+        """
+        if self.n_samples == 0:
+            raise ValueError('No samples were added.')
+        q = np.asarray(q, dtype=float)
+        if np.any((q < 0) | (q > 1)):
+            raise ValueError('Probabilities of the quantiles must be between 0 and 1.')
+        cdf = np.cumsum(self._counts, axis=0)
+        # smallest value whose cumulative count reaches q*n_samples
+        res = np.array([[np.searchsorted(cdf[:, i], max(p*self.n_samples, 1)) for i in range(self.n_sampling_times)] for p in q.ravel()])
+        return res.reshape(q.shape + (self.n_sampling_times,))
+
+
+class MomentsAccumulator:
+    r"""Streaming mean and variance of the abundance of a species at each sampling time, updated batch by batch 
+    with the parallel form of Welford's algorithm :cite:`chan1982updating`. Samples are not stored.
+
+    Args:
+        - **n_sampling_times** (int): Number of sampling times.
+    """
+    def __init__(self, n_sampling_times: int):
+        self.n_sampling_times = n_sampling_times
+        self.n_samples = 0
+        self.mean = np.zeros(n_sampling_times)
+        # sum of the squared deviations from the mean
+        self._m2 = np.zeros(n_sampling_times)
+
+    def update(self, samples: np.ndarray):
+        r"""Adds the abundances of a batch of trajectories.
+
+        Args:
+            - **samples** (np.ndarray): Abundances at the sampling times. Has shape :math:`(n, \text{n_sampling_times})`.
+        """
+        samples = np.asarray(samples, dtype=float)
+        n = len(samples)
+        if n == 0:
+            return
+        batch_mean = samples.mean(axis=0)
+        batch_m2 = ((samples - batch_mean)**2).sum(axis=0)
+        total = self.n_samples + n
+        delta = batch_mean - self.mean
+        self.mean = self.mean + delta*n/total
+        self._m2 = self._m2 + batch_m2 + delta**2*self.n_samples*n/total
+        self.n_samples = total
+
+    @property
+    def variance(self) -> np.ndarray:
+        r"""Unbiased sample variance at each sampling time."""
+        if self.n_samples < 2:
+            return np.full(self.n_sampling_times, np.nan)
+        return self._m2/(self.n_samples - 1)
+
+
+class LikelihoodRatioSensitivities:
+    r"""Estimates the marginal probability mass functions of a species and their sensitivities with respect to the parameters 
+    from SSA trajectories, with the likelihood ratio method: the score of each path is accumulated along the trajectory 
+    (see ``simulation.likelihood_ratio_simulate``) and
+
+    .. math::
+
+        \hat{p}(x, t) = \frac{1}{n}\sum_{r=1}^n \mathbb{1}_{X_t^r = x}, \quad 
+        \widehat{\partial_j p}(x, t) = \frac{1}{n}\sum_{r=1}^n \mathbb{1}_{X_t^r = x} S_j^r(t)
+
+    Unlike ``fsp.SensitivitiesDerivation``, its cost does not depend on the size of the state space, so that it can be used 
+    for CRNs which are too large for the Finite State Projection, at the price of a statistical error. Probabilities and 
+    sensitivities are added batch by batch and the trajectories are not stored.
+
+    Args:
+        - **crn** (simulation.CRN): CRN to work on. **propensities_drv** should be specified if it does not follow mass-action kinetics.
+        - :math:`n_{\text{trajectories}}` (int, optional): Number of trajectories to compute. Defaults to :math:`10^4`.
+        - **seed** (int, optional): Seed of the random number generators. If None, fresh entropy is used. Defaults to None.
+        - **batch_size** (int, optional): Number of trajectories simulated before being added to the estimates. Defaults to :math:`1000`.
+    """
+    def __init__(self, 
+                crn: simulation.CRN, 
+                n_trajectories: int =10**4, 
+                seed: int =None,
+                batch_size: int =1000):
+        self.crn = crn
+        self.n_trajectories = n_trajectories
+        self.seed = seed
+        self.batch_size = batch_size
+
+    def marginal(self,
+                sampling_times: np.ndarray,
+                time_windows: np.ndarray,
+                parameters: np.ndarray,
+                ind_species: int,
+                index: list =None,
+                n_values: int =None) -> np.ndarray:
+        r"""Estimates the marginal probability mass functions and their sensitivities, in the same format as 
+        ``fsp.SensitivitiesDerivation.marginal``.
+
+        Args:
+            - **sampling_times** (np.ndarray): Sampling times, strictly greater than :math:`0`.
+            - **time_windows** (np.ndarray): Time windows during which the parameters do not vary. Its form is :math:`[t_1, ..., t_L]`,
+              such that the considered time windows are :math:`[0, t_1], [t_1, t_2], ..., [t_{L-1}, t_L]`. :math:`t_L` must match
+              with the final time :math:`t_f`. If there is only one time window, **time_windows** should be defined as :math:`[t_f]`.
+            - **parameters** (np.ndarray): Parameters of the propensity functions for each time window. Has shape :math:`(L, M_{\theta}+M_{\xi})`.
+            - **ind_species** (int): Index of the species of interest.
+            - **index** (list, optional): Indices of the parameters among :math:`[\theta_1, ..., \theta_{M_{\theta}}, \xi_1^1, ..., \xi_L^{M_{\xi}}]`
+              with respect to which the sensitivities are estimated. If None, all parameters. Defaults to None.
+            - **n_values** (int, optional): Number of abundance values :math:`0, ..., n_{\text{values}}-1` to return. If None,
+              up to the maximum value reached. Defaults to None.
+
+        Returns:
+            - The estimated probabilities and sensitivities for each sampling time. Has shape :math:`(n_{\text{values}}, \text{n_sampling_times}, \text{len}(\text{index})+1)`.
+        """
+        if index is None:
+            index = np.arange(self.crn.n_fixed_params + self.crn.n_control_params*len(time_windows))
+        index = np.asarray(index)
+        n_sampling_times = len(sampling_times)
+        # sums of the indicator functions, and of the indicator functions weighted by the scores
+        sums = np.zeros((1, n_sampling_times, len(index)+1))
+        starts = range(0, self.n_trajectories, self.batch_size)
+        for start, batch_seed in zip(starts, np.random.SeedSequence(self.seed).spawn(len(starts))):
+            n = min(self.batch_size, self.n_trajectories - start)
+            values = np.empty((n, n_sampling_times), dtype=np.int64)
+            weights = np.ones((n, n_sampling_times, len(index)+1))
+            for i, trajectory_seed in enumerate(batch_seed.spawn(n)):
+                samples, scores = simulation.likelihood_ratio_simulate(self.crn, 
+                                                                        sampling_times, 
+                                                                        time_windows, 
+                                                                        parameters, 
+                                                                        rng=np.random.default_rng(trajectory_seed))
+                values[i] = samples[:, ind_species]
+                weights[i, :, 1:] = scores[:, index]
+            if values.max() >= len(sums):
+                sums = np.concatenate((sums, np.zeros((values.max() + 1 - len(sums),) + sums.shape[1:])))
+            np.add.at(sums, (values, np.arange(n_sampling_times)), weights)
+        if n_values is None:
+            n_values = len(sums)
+        marginal_distributions = np.zeros((n_values,) + sums.shape[1:])
+        n = min(n_values, len(sums))
+        marginal_distributions[:n] = sums[:n]
+        return marginal_distributions / self.n_trajectories
+
+
 class CRN_Dataset:
     r"""Class to build a dataset of probability distributions for a specified CRN.
 
@@ -22,17 +216,37 @@ class CRN_Dataset:
           with the final time :math:`t_f`. If there is only one time window, it should be defined as :math:`[t_f]`.
         - :math:`n_{\text{trajectories}}` (int, optional): Number of trajectories to compute. 
           Can also be defined when calling the ``generate_data`` function. Defaults to :math:`10^4`.
-        - **ind_species** (int, optional): Index of the species of interest. 
-          The distribution generated will be the one of that species. Defaults to :math:`0`.
+        - **ind_species** (Union[int, list], optional): Index of the species of interest. 
+          The distribution generated will be the one of that species. If it is a list of indices, the distributions of all
+          these species are estimated from the same simulations. Defaults to :math:`0`.
         - **method** (str, optional): Stochastic Simulation to compute. Defaults to `SSA`.
+        - **batch_size** (int, optional): Number of trajectories simulated at once before their abundances are added to the 
+          histograms and discarded. Defaults to :math:`2500`.
+        - **seed** (int, optional): Seed of the random number generators. Independent streams are derived from it for each set 
+          of parameters, batch and trajectory, so that the datasets do not depend on the number of processes. If None, 
+          fresh entropy is used. Defaults to None.
+        - **method_options** (dict, optional): Keyword arguments of the simulation method, for instance ``{'dt': 0.01}`` for `CLE`.
+          Defaults to None.
+        - **max_abundances** (np.ndarray, optional): Maximal abundance of each species. A trajectory whose abundances exceed it is 
+          stopped and its state remains the same until the final time. If None, no maximal abundance. Defaults to None.
+        - **max_events** (int, optional): Maximal number of events of a trajectory, after which it is stopped in the same way. 
+          Bounds the simulation time of unbounded networks. If None, no maximal number of events. Defaults to None.
+
+    The number of stopped trajectories for each set of parameters of the last generated dataset can be found in the attribute 
+    **n_capped**.
     """
     def __init__(self, 
             crn: simulation.CRN, 
             sampling_times: np.ndarray, 
             time_windows: np.ndarray,
             n_trajectories: int =10**4, 
-            ind_species: int =0,
-            method: str ='SSA'):     
+            ind_species: Union[int, list] =0,
+            method: str ='SSA',
+            batch_size: int =2500,
+            seed: int =None,
+            method_options: dict =None,
+            max_abundances: np.ndarray =None,
+            max_events: int =None):     
         self.crn = crn
         self.n_fixed_params = crn.n_fixed_params
         self.n_control_params = crn.n_control_params
@@ -44,50 +258,98 @@ class CRN_Dataset:
         self.sampling_times = sampling_times
         self.n_trajectories = n_trajectories
         self.ind_species = ind_species
+        # species whose distributions are estimated
+        self.several_species = isinstance(ind_species, (list, tuple, np.ndarray))
+        self.species = list(ind_species) if self.several_species else [ind_species]
         self.initial_state = crn.init_state
         self.method = method
         self.time_windows = time_windows
+        self.batch_size = batch_size
+        self.seed = seed
+        self.method_options = method_options
+        self.max_abundances = max_abundances
+        self.max_events = max_events
+        self.n_capped = None
 
 
-    def samples_probs(self, params: np.ndarray) -> Tuple[list, int]:
+    def samples_probs(self, params: np.ndarray, seed: np.random.SeedSequence =None) -> Tuple[list, int, int]:
         r"""Runs :math:`n_{\text{trajectories}}` of Stochastic Simulations for the parameters in input and estimates the 
         corresponding distribution for the species indexed by **ind_species**.
 
         Args:
             - **params** (np.ndarray): Parameters associated to the propensity functions for each time window. Array of shape 
               :math:`(L, M_{\theta}+M_{\xi})`.
+            - **seed** (np.random.SeedSequence, optional): Seed sequence from which the random number generators are derived. 
+              If None, it is built from **seed** as defined in the constructor. Defaults to None.
         Returns:
             - **samples**: List of the distributions for the corresponding species at sampling times. This list begins with time and 
               parameters: :math:`[t, \theta_1, ..., \theta_{M_{\theta}}, \xi_1^1, \xi_1^2, ..., \xi_1^{M_{\xi}}, ..., \xi^{M_{\xi}}_L, p_0(t,\theta,\xi), ...]`.
+              If **ind_species** is a list, list of such lists, one for each species.
             - **max_value**: Maximum value reached during simulations :math:`+ M_{\text{tot}} + 1` (for time). 
               Used to standardise the length to turn the list of data vectors into an array.
+            - **n_capped**: Number of trajectories stopped because of **max_abundances** or **max_events**.
         """
-        res = []
-        for i in range(self.n_trajectories):
-            self.crn.simulation(sampling_times=self.sampling_times, 
-                                time_windows=self.time_windows,
-                                parameters=params, 
-                                method=self.method,
-                                complete_trajectory=False)
-            res.append(self.crn.sampling_states)
-            self.crn.reset()
-        res = np.array(res)
-        max_value = int(np.max(res))
-        # Counts of events for each species
-        distr = np.empty((int(max_value) + 1, len(self.sampling_times), self.crn.n_species))
-        for i in range(int(max_value)+1):
-            distr[i,:,:] = np.count_nonzero((res == i), axis=0)
+        # the trajectories are added to the histograms batch by batch, and then discarded
+        histograms = [HistogramAccumulator(len(self.sampling_times)) for _ in self.species]
+        max_value = 0
+        n_capped = 0
+        # the simulations also return which trajectories were stopped
+        check_caps = self.max_abundances is not None or self.max_events is not None
+        if seed is None:
+            seed = np.random.SeedSequence(self.seed)
+        starts = range(0, self.n_trajectories, self.batch_size)
+        for start, batch_seed in zip(starts, seed.spawn(len(starts))):
+            n = min(self.batch_size, self.n_trajectories - start)
+            if self.method in ['SSA', 'CLE']:
+                # all trajectories of the batch are computed at once
+                res = self.crn.ensemble_simulation(sampling_times=self.sampling_times,
+                                                    time_windows=self.time_windows,
+                                                    parameters=params,
+                                                    n_trajectories=n,
+                                                    method=self.method,
+                                                    rng=np.random.default_rng(batch_seed),
+                                                    method_options=self.method_options,
+                                                    max_abundances=self.max_abundances,
+                                                    max_events=self.max_events)
+                if check_caps:
+                    res, capped = res
+                    n_capped += int(capped.sum())
+            else:
+                res = np.empty((n, len(self.sampling_times), self.n_species))
+                for i, trajectory_seed in enumerate(batch_seed.spawn(n)):
+                    out = simulation.simulate(self.crn,
+                                            sampling_times=self.sampling_times, 
+                                            time_windows=self.time_windows,
+                                            parameters=params, 
+                                            rng=np.random.default_rng(trajectory_seed),
+                                            method=self.method,
+                                            method_options=self.method_options,
+                                            max_abundances=self.max_abundances,
+                                            max_events=self.max_events)
+                    res[i] = out[1]
+                    if check_caps:
+                        n_capped += int(out[2])
+            max_value = max(max_value, int(np.max(res)))
+            for species, histogram in zip(self.species, histograms):
+                histogram.update(res[:, :, species])
         # final output
-        samples = []
         control_parameters = []
         for i in range(self.n_time_windows):
             control_parameters.append(params[i, self.n_fixed_params:])
         control_parameters = list(np.concatenate(control_parameters))
-        for i, t in enumerate(self.sampling_times):
-            sample = [t] + list(params[0, :self.n_fixed_params]) + control_parameters + list(distr[:, i, self.ind_species])
-            samples.append(sample)
+        all_samples = []
+        for histogram in histograms:
+            # Counts of events for the species of interest, for values up to the maximum value reached by any species
+            distr = histogram.counts(max_value + 1)
+            samples = []
+            for i, t in enumerate(self.sampling_times):
+                sample = [t] + list(params[0, :self.n_fixed_params]) + control_parameters + list(distr[:, i])
+                samples.append(sample)
+            all_samples.append(samples)
+        if not(self.several_species):
+            all_samples = all_samples[0]
         # + 1 to count the time
-        return samples, max_value + self.total_n_params + 1
+        return all_samples, max_value + self.total_n_params + 1, n_capped
 
     def set_length(self, onedim_tab: np.ndarray, length: int) -> np.ndarray:
         """Adds enough zeros at the end of an array to adjust its length.
@@ -105,7 +367,7 @@ class CRN_Dataset:
                     data_length: int, 
                     sobol_start: np.ndarray =None,
                     sobol_end: np.ndarray =None,
-                    n_trajectories: int =10**4) -> Tuple[np.ndarray]:
+                    n_trajectories: int =10**4) -> Union[Tuple[np.ndarray], dict]:
         r"""Generates a dataset which can be used for training, validation or testing.
         Uses multiprocessing to run multiple simulations in parallel.
         Parameters are generated from the Sobol Sequence (Low Discrepancy Sequence).
@@ -125,6 +387,13 @@ class CRN_Dataset:
                 - Each entry of **X** is an input to the neural network of the form 
                   :math:`[t, \theta_1,..., \theta_{M_{\theta}}, \xi_1^1, ..., \xi_1^{M_{\xi}}, \xi_2^1, ..., \xi^{M_{\xi}}_L]`.
                 - The corresponding entry of **y** is the estimated probability distribution for these parameters.
+
+              If **ind_species** is a list, dictionary whose keys are the indices of the species and whose values are the 
+              corresponding datasets **(X, y)**, all computed from the same simulations.
+
+            The number of stopped trajectories for each set of parameters is saved in the attribute **n_capped**, an array of
+            shape :math:`(n_{\text{sets}},)`. The rows :math:`i\times\text{n_sampling_times}, ..., (i+1)\times\text{n_sampling_times}-1` 
+            of **X** and **y** correspond to the :math:`i`-th set.
         """
         if sobol_start is None:
             sobol_start = np.zeros(self.n_params)
@@ -132,8 +401,10 @@ class CRN_Dataset:
             sobol_end = np.ones(self.n_params)
         self.n_trajectories = n_trajectories
         start = time.time()
+        # independent seeds for the scrambling of the Sobol sequences and for the simulations
+        theta_seed, xi_seed, simulations_seed = np.random.SeedSequence(self.seed).spawn(3)
         # generating parameters theta_i
-        sobol_theta = qmc.Sobol(self.n_fixed_params)
+        sobol_theta = qmc.Sobol(self.n_fixed_params, seed=np.random.default_rng(theta_seed))
         # sobol sequence requires a power of 2
         n_elts = 2**math.ceil(np.log2(data_length))
         thetas = sobol_theta.random(n_elts)*(sobol_end[:self.n_fixed_params]-sobol_start[:self.n_fixed_params])+sobol_start[:self.n_fixed_params] 
@@ -141,7 +412,7 @@ class CRN_Dataset:
         thetas[np.count_nonzero(thetas, axis=1) == 0] = sobol_theta.random()*(sobol_end[:self.n_fixed_params]-sobol_start[:self.n_fixed_params])+sobol_start[:self.n_fixed_params]
         theta = np.stack([thetas]*self.n_time_windows, axis=1) # shape (n_elts, L, q_1+q_2)
         # generating parameters xi_i
-        sobol_xi = qmc.Sobol(self.n_control_params*self.n_time_windows)
+        sobol_xi = qmc.Sobol(self.n_control_params*self.n_time_windows, seed=np.random.default_rng(xi_seed))
         xi = sobol_xi.random(n_elts)
         # to avoid all zeros
         xi[np.count_nonzero(xi, axis=1)==0] = sobol_xi.random()
@@ -150,26 +421,34 @@ class CRN_Dataset:
         xi = xi*(sobol_end[self.n_fixed_params:] - sobol_start[self.n_fixed_params:]) + sobol_start[self.n_fixed_params:]
         params = np.concatenate((theta, xi), axis=-1) # shape (n_elts, L, M_theta + q_1+q_2)
         # using multithreading to process faster
+        # one independent seed sequence for each set of parameters, whichever process computes it
+        seeds = simulations_seed.spawn(n_elts)
         with concurrent.futures.ProcessPoolExecutor() as executor:
-            res = list(tqdm(executor.map(self.samples_probs, params), total=n_elts, desc='Generating data ...'))
+            res = list(tqdm(executor.map(self.samples_probs, params, seeds), total=n_elts, desc='Generating data ...'))
         print('Simulations done.')
-        distributions = []
-        max_value = 0
-        for distrs, value in res:
-            for distr in distrs:
-                distributions.append(distr)
-            if value > max_value:
-                max_value = value
-        # shaping distributions to turn it into an array
-        distributions = list(map(lambda d: self.set_length(d, max_value + 1), distributions))
-        distributions = np.array(distributions)
-        # split 'distributions' into input data and output data
-        # input data contains all the parameters used for the simulation, including the sets of parameters for each time window
-        X = distributions[:, :1+self.total_n_params].copy()
-        y = distributions[:, 1+self.total_n_params:].copy()/n_trajectories
+        self.n_capped = np.array([n_capped for _, _, n_capped in res])
+        if self.n_capped.any():
+            print(f'{self.n_capped.sum()} trajectories stopped for {np.count_nonzero(self.n_capped)} sets of parameters.')
+        max_value = max(value for _, value, _ in res)
+        datasets = {}
+        for j, species in enumerate(self.species):
+            distributions = []
+            for distrs, _, _ in res:
+                for distr in (distrs[j] if self.several_species else distrs):
+                    distributions.append(distr)
+            # shaping distributions to turn it into an array
+            distributions = list(map(lambda d: self.set_length(d, max_value + 1), distributions))
+            distributions = np.array(distributions)
+            # split 'distributions' into input data and output data
+            # input data contains all the parameters used for the simulation, including the sets of parameters for each time window
+            X = distributions[:, :1+self.total_n_params].copy()
+            y = distributions[:, 1+self.total_n_params:].copy()/n_trajectories
+            datasets[species] = (X, y)
         end=time.time()
         print('Total time: ', end-start)
-        return X, y
+        if self.several_species:
+            return datasets
+        return datasets[self.ind_species]
 
 class CRN_Simulations:
     r"""Class to run simulations over time and to estimate the abundance evolution of a species.
@@ -186,6 +465,18 @@ class CRN_Simulations:
           computes the abundance of the species to study at the specified sampling times. Defaults to True.
         - **sampling_times** (np.ndarray, optional): Sampling times. Should not be specified when **complete_trajectory** is True.
           Defaults to `np.empty(0)`.
+        - **seed** (int, optional): Seed of the random number generators. Independent streams are derived from it for each 
+          chunk of trajectories and each trajectory, so that the results do not depend on the number of processes. 
+          If None, fresh entropy is used. Defaults to None.
+        - **method_options** (dict, optional): Keyword arguments of the simulation method, for instance ``{'dt': 0.01}`` for `CLE`.
+          Defaults to None.
+        - **n_workers** (int, optional): Number of processes computing the chunks of trajectories in parallel. If None, as many 
+          processes as processors. If :math:`1`, all simulations are computed in the current process. Defaults to None.
+        - **chunk_size** (int, optional): Number of trajectories computed by a process at once. When there is a single chunk,
+          it is computed in the current process. Defaults to :math:`1000`.
+        - **record_every** (int, optional): When **complete_trajectory** is True, only one jump out of **record_every** is saved, 
+          as well as the state at the end of each time window. To record the abundances on a uniform time grid instead, 
+          set **complete_trajectory** to False and use the grid as **sampling_times**. Defaults to :math:`1`.
     """     
     def __init__(self, 
             crn: simulation.CRN,
@@ -194,7 +485,12 @@ class CRN_Simulations:
             ind_species: int =0,
             method: str ='SSA',
             complete_trajectory: bool =True,
-            sampling_times: np.ndarray =np.empty(0)):
+            sampling_times: np.ndarray =np.empty(0),
+            seed: int =None,
+            method_options: dict =None,
+            n_workers: int =None,
+            chunk_size: int =1000,
+            record_every: int =1):
         self.crn = crn
         self.n_fixed_params = crn.n_fixed_params
         self.n_control_params = crn.n_control_params
@@ -210,6 +506,11 @@ class CRN_Simulations:
         self.complete_trajectory = complete_trajectory
         self.time_windows = time_windows
         self.sampling_times = sampling_times
+        self.seed = seed
+        self.method_options = method_options
+        self.n_workers = n_workers
+        self.chunk_size = chunk_size
+        self.record_every = record_every
 
 
     def run_simulations(self, params: np.ndarray) -> Union[Tuple[dict], Tuple[np.ndarray]]:
@@ -230,38 +531,229 @@ class CRN_Simulations:
                 - **samples** (np.ndarray): Measured abundance for each trajectory at the sampling times. Shape (n_trajectories, n_sampling_times).
                 - **times** (np.ndarray): Sampling times.
         """
+        res = list(self.iter_simulations(params, batches=True))
+        if not(self.complete_trajectory):
+            return np.concatenate([samples for samples, _ in res]), self.sampling_times
+        samples = {}
+        times = {}
+        for chunk_samples, chunk_times in res:
+            samples.update(chunk_samples)
+            times.update(chunk_times)
+        return samples, times
+
+    def summary_statistics(self, params: np.ndarray, q: Union[float, list] =None) -> Tuple[np.ndarray]:
+        r"""Runs :math:`n_{\text{trajectories}}` of Stochastic Simulations and computes the mean and the variance of the 
+        abundance at each sampling time, and optionally some quantiles. The samples are processed chunk by chunk and are not stored, 
+        so that the memory used does not depend on :math:`n_{\text{trajectories}}`. Requires **complete_trajectory** to be False.
+
+        Args:
+            - **params** (np.ndarray): Parameters associated to the propensity functions for each time window. Array of shape 
+              :math:`(L, M_{\theta}+M_{\xi})`.
+            - **q** (Union[float, list], optional): Probabilities of the quantiles to compute. If None, no quantile is computed. 
+              Defaults to None.
+
+        Returns:
+            - **mean** (np.ndarray): Mean abundance at each sampling time.
+            - **variance** (np.ndarray): Variance of the abundance at each sampling time.
+            - **quantiles** (np.ndarray): Only if **q** is not None. Quantiles as returned by ``HistogramAccumulator.quantiles``.
+        """
+        if self.complete_trajectory:
+            raise ValueError('Summary statistics are computed at the sampling times, complete_trajectory should be False.')
+        moments = MomentsAccumulator(len(self.sampling_times))
+        histograms = HistogramAccumulator(len(self.sampling_times)) if q is not None else None
+        for samples, _ in self.iter_simulations(params, batches=True):
+            moments.update(samples)
+            if histograms is not None:
+                histograms.update(samples)
+        if histograms is None:
+            return moments.mean, moments.variance
+        return moments.mean, moments.variance, histograms.quantiles(q)
+
+    def iter_simulations(self, params: np.ndarray, batches: bool =False):
+        r"""Runs :math:`n_{\text{trajectories}}` of Stochastic Simulations as ``run_simulations`` does, but yields the 
+        trajectories as soon as their chunk is computed, so that they can be processed incrementally. At most twice as many 
+        chunks as processes are computed ahead of the consumer: the memory used depends on **chunk_size** and not on 
+        :math:`n_{\text{trajectories}}`.
+
+        Args:
+            - **params** (np.ndarray): Parameters associated to the propensity functions for each time window. Array of shape 
+              :math:`(L, M_{\theta}+M_{\xi})`.
+            - **batches** (bool, optional): If True, yields the chunks of trajectories. Otherwise, yields the trajectories one by one. 
+              Defaults to False.
+
+        Yields:
+            - If **batches** is True, **(samples, times)** for each chunk, as defined in ``run_simulations``. When **complete_trajectory** 
+              is True, the keys of the dictionaries are the indices of the trajectories among all chunks.
+            - Otherwise, **(samples, times)** for each trajectory: the abundances and the corresponding times.
+        """
+        parameters = self._parameters(params)
+        starts = range(0, self.n_trajectories, self.chunk_size)
+        chunks = [min(self.chunk_size, self.n_trajectories - start) for start in starts]
+        seeds = np.random.SeedSequence(self.seed).spawn(len(chunks))
+        if len(chunks) == 1 or self.n_workers == 1:
+            results = (self.run_chunk(parameters, n, seed) for n, seed in zip(chunks, seeds))
+            yield from self._unpack_chunks(starts, results, batches)
+        else:
+            with concurrent.futures.ProcessPoolExecutor(self.n_workers) as executor:
+                max_pending = 2*(self.n_workers or os.cpu_count() or 1)
+                yield from self._unpack_chunks(starts, self._bounded_map(executor, parameters, chunks, seeds, max_pending), batches)
+
+    def run_common_simulations(self, params: np.ndarray) -> Tuple[np.ndarray]:
+        r"""Runs :math:`n_{\text{trajectories}}` of Stochastic Simulations for each of several sets of parameters with common 
+        random numbers: the :math:`i`-th trajectories of all sets are driven by the same Poisson processes for each reaction 
+        (see ``simulation.PoissonClocks``). The trajectories of neighbouring sets of parameters are then strongly correlated, so 
+        that differences between sets, as in finite-difference checks of gradients or parameter sweeps, are estimated with 
+        a much lower variance than with independent simulations. Requires **complete_trajectory** to be False and 
+        **method** to be `mNRM`.
+
+        Args:
+            - **params** (np.ndarray): Sets of parameters. Has shape :math:`(n_{\text{sets}}, M_{\text{tot}})`.
+
+        Returns:
+            - **samples** (np.ndarray): Measured abundance for each set of parameters and each trajectory at the sampling times. 
+              Has shape :math:`(n_{\text{sets}}, n_{\text{trajectories}}, \text{n_sampling_times})`.
+            - **times** (np.ndarray): Sampling times.
+        """
+        if self.complete_trajectory:
+            raise ValueError('Common random numbers are used at the sampling times, complete_trajectory should be False.')
+        if self.method != 'mNRM':
+            raise ValueError('Common random numbers require the random time change representation of the mNRM method.')
+        parameters = np.stack([self._parameters(p) for p in params])
+        chunks = [min(self.chunk_size, self.n_trajectories - start) for start in range(0, self.n_trajectories, self.chunk_size)]
+        seeds = np.random.SeedSequence(self.seed).spawn(len(chunks))
+        if len(chunks) == 1 or self.n_workers == 1:
+            res = list(map(self.run_common_chunk, [parameters]*len(chunks), chunks, seeds))
+        else:
+            with concurrent.futures.ProcessPoolExecutor(self.n_workers) as executor:
+                res = list(executor.map(self.run_common_chunk, [parameters]*len(chunks), chunks, seeds))
+        return np.concatenate(res, axis=1), self.sampling_times
+
+    def run_common_chunk(self, 
+                        parameters: np.ndarray, 
+                        n_trajectories: int, 
+                        seed: np.random.SeedSequence) -> np.ndarray:
+        r"""Runs a chunk of Stochastic Simulations with common random numbers in the current process.
+
+        Args:
+            - **parameters** (np.ndarray): Parameters of the simulation for each set and each time window. 
+              Has shape :math:`(n_{\text{sets}}, L, M_{\theta}+M_{\xi})`.
+            - :math:`n_{\text{trajectories}}` (int): Number of trajectories to compute for each set.
+            - **seed** (np.random.SeedSequence): Seed sequence from which the Poisson processes are derived.
+
+        Returns:
+            - **samples** as defined in ``run_common_simulations``, for the trajectories of the chunk.
+        """
+        samples = np.zeros((len(parameters), n_trajectories, len(self.sampling_times)))
+        for i, trajectory_seed in enumerate(seed.spawn(n_trajectories)):
+            for j, set_parameters in enumerate(parameters):
+                # new clocks with the same random numbers for each set of parameters
+                options = dict(self.method_options or {}, clocks=simulation.PoissonClocks.from_seed(trajectory_seed, self.crn.n_reactions))
+                _, sampling_states = simulation.simulate(self.crn,
+                                                        sampling_times=self.sampling_times, 
+                                                        time_windows=self.time_windows,
+                                                        parameters=set_parameters,
+                                                        rng=np.random.default_rng(trajectory_seed),
+                                                        method='mNRM',
+                                                        method_options=options)
+                if self.sampling_times[0] == 0:
+                    samples[j, i, 0] = self.initial_state[self.ind_species]
+                    samples[j, i, 1:] = sampling_states[:, self.ind_species]
+                else:
+                    samples[j, i] = sampling_states[:, self.ind_species]
+        return samples
+
+    def _parameters(self, params: np.ndarray) -> np.ndarray:
+        # parameters of each time window, of shape (L, M_theta + M_xi)
+        fixed_params = np.stack([params[:self.n_fixed_params]]*self.n_time_windows)
+        control_params = np.reshape(params[self.n_fixed_params:], (self.n_time_windows, self.n_control_params))
+        return np.concatenate((fixed_params, control_params), axis=-1)
+
+    def _bounded_map(self, executor, parameters, chunks, seeds, max_pending):
+        # submits the chunks as results are consumed, in order
+        pending = collections.deque()
+        for n, seed in zip(chunks, seeds):
+            pending.append(executor.submit(self.run_chunk, parameters, n, seed))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+    def _unpack_chunks(self, starts, results, batches: bool):
+        for start, (samples, times) in zip(starts, results):
+            if self.complete_trajectory:
+                # trajectories are numbered across chunks
+                samples = {start + i: sample for i, sample in samples.items()}
+                times = {start + i: time for i, time in times.items()}
+            if batches:
+                yield samples, times
+            else:
+                for i in range(len(samples)):
+                    if self.complete_trajectory:
+                        yield samples[start + i], times[start + i]
+                    else:
+                        yield samples[i], times
+
+    def run_chunk(self, 
+                parameters: np.ndarray, 
+                n_trajectories: int, 
+                seed: np.random.SeedSequence) -> Union[Tuple[dict], Tuple[np.ndarray]]:
+        r"""Runs a chunk of Stochastic Simulations in the current process.
+
+        Args:
+            - **parameters** (np.ndarray): Parameters of the simulation for each time window. Has shape :math:`(L, M_{\theta}+M_{\xi})`.
+            - :math:`n_{\text{trajectories}}` (int): Number of trajectories to compute.
+            - **seed** (np.random.SeedSequence): Seed sequence from which the random number generators are derived.
+
+        Returns:
+            - **(samples, times)** as defined in ``run_simulations``, for the trajectories of the chunk.
+        """
         if self.complete_trajectory:
             samples = {}
             times = {}
         else:
-            samples = np.zeros((self.n_trajectories, len(self.sampling_times)))
+            samples = np.zeros((n_trajectories, len(self.sampling_times)))
             times = self.sampling_times
-        fixed_params = np.stack([params[:self.n_fixed_params]]*self.n_time_windows)
-        control_params = np.reshape(params[self.n_fixed_params:], (self.n_time_windows, self.n_control_params))
-        parameters = np.concatenate((fixed_params, control_params), axis=-1)
-        for i in range(self.n_trajectories):
-            self.crn.simulation(sampling_times=self.sampling_times, 
-                                time_windows=self.time_windows,
-                                parameters=parameters, 
-                                method=self.method,
-                                complete_trajectory=self.complete_trajectory)
+        if not(self.complete_trajectory) and self.method in ['SSA', 'CLE']:
+            # all trajectories are computed at once
+            res = self.crn.ensemble_simulation(sampling_times=self.sampling_times,
+                                                time_windows=self.time_windows,
+                                                parameters=parameters,
+                                                n_trajectories=n_trajectories,
+                                                method=self.method,
+                                                rng=np.random.default_rng(seed),
+                                                method_options=self.method_options)[:, :, self.ind_species]
+            if times[0] == 0:
+                samples[:, 0] = self.initial_state[self.ind_species]
+                samples[:, 1:] = res
+            else:
+                samples[:, :] = res
+            return samples, times
+        for i, trajectory_seed in enumerate(seed.spawn(n_trajectories)):
+            sampling_times, sampling_states = simulation.simulate(self.crn,
+                                                                sampling_times=self.sampling_times, 
+                                                                time_windows=self.time_windows,
+                                                                parameters=parameters, 
+                                                                rng=np.random.default_rng(trajectory_seed),
+                                                                method=self.method,
+                                                                complete_trajectory=self.complete_trajectory,
+                                                                method_options=self.method_options,
+                                                                record_every=self.record_every)
             if self.complete_trajectory:
-                times[i] = np.concatenate((np.array([0]), self.crn.sampling_times))
-                samples[i] = np.concatenate((np.array([self.initial_state[self.ind_species]]), self.crn.sampling_states[:, self.ind_species]))
+                times[i] = np.concatenate((np.array([0]), sampling_times))
+                samples[i] = np.concatenate((np.array([self.initial_state[self.ind_species]]), sampling_states[:, self.ind_species]))
             else:
                 if times[0] == 0:
-                    samples[i,:] = np.concatenate((np.array([self.initial_state[self.ind_species]]), self.crn.sampling_states[:, self.ind_species]))
+                    samples[i,:] = np.concatenate((np.array([self.initial_state[self.ind_species]]), sampling_states[:, self.ind_species]))
                 else:
-                    samples[i,:] = self.crn.sampling_states[:, self.ind_species]
-            self.crn.reset()
+                    samples[i,:] = sampling_states[:, self.ind_species]
         return samples, times
 
     def plot_simulations(self, 
                         params: np.ndarray,
                         targets: np.ndarray =None, 
                         save: Tuple[bool, str] =(False, None)):
-        r"""Plots either all the simulated trajectories if **complete_trajectory** is False or 
-        the mean evolution of the abundance if **complete_trajectory** is True.
+        r"""Plots either all the simulated trajectories if **complete_trajectory** is True or 
+        the mean evolution of the abundance and its 95% confidence interval if **complete_trajectory** is False.
 
         Args:
             - **params** (np.ndarray): Parameters associated to the propensity functions for each time window. Array of shape 
@@ -270,17 +762,19 @@ class CRN_Simulations:
             - **save** (Tuple[bool, str], optional): If the first argument is True, saves the plot. The second argument 
               is the name of the file under which to save the plot. Defaults to (False, None).
         """        
-        samples, times = self.run_simulations(params)
         if self.complete_trajectory:
-            for i in range(self.n_trajectories):
-                edges = np.concatenate((times[i], self.time_windows[-1:]))
-                plt.stairs(values=samples[i], edges=edges, baseline=None, orientation='vertical')
+            # trajectories are plotted as soon as they are computed
+            for sample, time in self.iter_simulations(params):
+                edges = np.concatenate((time, self.time_windows[-1:]))
+                plt.stairs(values=sample, edges=edges, baseline=None, orientation='vertical')
         else:
-            data = pd.DataFrame(samples.transpose(), columns = [f'Abundance{i}' for i in range(self.n_trajectories)])
-            data['id'] = data.index
-            data['time'] = times
-            data = pd.wide_to_long(data, ['Abundance'], i='time', j='id')
-            seaborn.lineplot(data=data, x='time', y='Abundance')
+            # the samples are not stored
+            mean, variance = self.summary_statistics(params)
+            half_width = 1.96*np.sqrt(variance/self.n_trajectories)
+            lines = plt.plot(self.sampling_times, mean)
+            plt.fill_between(self.sampling_times, mean - half_width, mean + half_width, color=lines[0].get_color(), alpha=0.2)
+            plt.xlabel('time')
+            plt.ylabel('Abundance')
         if targets is not None: # shape (n_targets,2)
             plt.scatter(x=targets[:,0], y=targets[:,1], marker='x', c='black', label='target values')
             plt.legend()
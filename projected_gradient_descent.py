@@ -254,8 +254,8 @@ class ProjectedGradientDescent_CRN(ProjectedGradientDescent):
         n = max(n_iter//rate, 1)
         for i in range(n):
             parameters = np.concatenate((self.fixed_parameters, self.buffer_params[i*rate,:]))
-            samples, _ = sim.run_simulations(parameters)
-            res.append(np.mean(samples, axis=0))
+            mean, _ = sim.summary_statistics(parameters)
+            res.append(mean)
         res = np.array(res)
         for i, t in enumerate(self.time_windows):
             plt.scatter(np.linspace(0, n_iter, n), res[:,i], marker = '+', label=f'$t={t}$')
@@ -292,8 +292,7 @@ class ProjectedGradientDescent_CRN(ProjectedGradientDescent):
         performance_index = np.zeros(n_iter//rate)
         for i in range(n_iter//rate):
             parameters = np.concatenate((self.fixed_parameters, self.buffer_params[i*rate,:]))
-            samples, _ = sim.run_simulations(parameters)
-            expect = np.mean(samples, axis=0)
+            expect, _ = sim.summary_statistics(parameters)
             res = 0
             for j in range(self.n_time_windows):
                 res += self.weights[j] * self.loss_function[j](expect[j])
@@ -429,6 +428,9 @@ class ProjectedGradientDescent_FSP(ProjectedGradientDescent_CRN):
           have no influence on that time window. If False, works with the computed sensitivities. Defaults to True.
         - :math:`C_r` (int, optional): Value such that :math:`(0, .., 0, C_r)` is the last value in the truncated space. 
           Defaults to :math:`50`.
+        - **tol** (float, optional): Tolerance on the probability mass which leaves the truncated state space. If specified, 
+          the truncated state space starts from :math:`C_r` and is expanded when needed at each iteration, see ``fsp.SensitivitiesDerivation``.
+          Defaults to None.
     """       
     def __init__(self,
                 crn: simulation.CRN,
@@ -439,14 +441,16 @@ class ProjectedGradientDescent_FSP(ProjectedGradientDescent_CRN):
                 loss: Union[Callable, list],
                 grad_loss: Union[Callable, list],
                 weights: np.ndarray =None,
-                cr: int =50): 
+                cr: int =50,
+                tol: float =None): 
         super().__init__(crn=crn, domain=domain, fixed_params=fixed_params, time_windows=time_windows, loss=loss, weights=weights)
         self.ind_species = ind_species
         self.stv_calculator = fsp.SensitivitiesDerivation(self.crn, 
                                                         self.n_time_windows, 
                                                         # only the control parameters
                                                         index=np.arange(crn.n_fixed_params, crn.n_fixed_params+crn.n_control_params), 
-                                                        cr=cr)
+                                                        cr=cr,
+                                                        tol=tol)
         self.grad_loss_function = grad_loss
         self.create_gradient()
         self.create_loss()
@@ -0,0 +1,296 @@
+import numpy as np
+from typing import Union, Tuple
+
+
+def zeros(params, x):
+    return 0
+
+
+def _resolve(value: Union[str, float], names: list) -> Tuple[int, float]:
+    # a value is either the name of a parameter or a constant
+    if isinstance(value, str):
+        if value not in names:
+            raise ValueError(f"Unknown parameter {value}.")
+        return names.index(value), None
+    return None, float(value)
+
+
+def _get(params: np.ndarray, index: int, constant: float) -> float:
+    return params[index] if index is not None else constant
+
+
+class MassAction:
+    r"""Mass-action rate term :math:`c \prod_i x_i (x_i-1) \dots (x_i-r_i+1)`, where :math:`r_i` is the number of molecules of the
+    species :math:`i` consumed by the reaction.
+
+    Args:
+        - **rate** (Union[str, float]): Name of the rate parameter :math:`c`, or its constant value.
+        - **reactants** (dict, optional): Orders :math:`r_i` of the term, indexed by species names. If None, the reactants of
+          the reaction are used. An empty dictionary gives a constant term. Defaults to None.
+    """
+    def __init__(self, rate: Union[str, float], reactants: dict =None):
+        self.rate = rate
+        self.reactants = reactants
+
+    def resolve(self, species: list, parameters: list, reaction_reactants: dict):
+        """Converts the names of species and parameters into indices.
+
+        Args:
+            - **species** (list): Names of the species of the network.
+            - **parameters** (list): Names of the parameters of the network.
+            - **reaction_reactants** (dict): Reactants of the reaction the term belongs to.
+        """
+        reactants = reaction_reactants if self.reactants is None else self.reactants
+        self.rate_index, self.rate_constant = _resolve(self.rate, parameters)
+        self.orders = np.zeros(len(species), dtype=int)
+        for name, order in reactants.items():
+            self.orders[species.index(name)] = order
+        self.species = np.flatnonzero(self.orders)
+        self.parameters = {self.rate_index} - {None}
+
+    def propensity(self, x: np.ndarray) -> np.ndarray:
+        # falling factorials of the abundances, without the rate
+        value = 1.
+        for i in self.species:
+            for o in range(self.orders[i]):
+                value = value * (x[i] - o)
+        return value
+
+    def value(self, params: np.ndarray, x: np.ndarray) -> np.ndarray:
+        """Evaluates the term.
+
+        Args:
+            - **params** (np.ndarray): Parameters of the network.
+            - **x** (np.ndarray): Abundances. ``x[i]`` can either be a scalar or an array.
+        """
+        return _get(params, self.rate_index, self.rate_constant) * self.propensity(x)
+
+    def partial(self, params: np.ndarray, x: np.ndarray, j: int) -> np.ndarray:
+        """Evaluates the derivative of the term with respect to the parameter :math:`j`.
+
+        Args:
+            - **params** (np.ndarray): Parameters of the network.
+            - **x** (np.ndarray): Abundances. ``x[i]`` can either be a scalar or an array.
+            - **j** (int): Index of the parameter.
+        """
+        if j == self.rate_index:
+            return self.propensity(x)
+        return 0.
+
+
+class Hill:
+    r"""Hill rate term regulated by a species :math:`y`.
+
+    .. math::
+
+        \frac{c}{1 + \alpha y^{\eta}} \text{ (repression) or } \frac{c \alpha y^{\eta}}{1 + \alpha y^{\eta}} \text{ (activation)}
+
+    Args:
+        - **rate** (Union[str, float]): Name of the rate parameter :math:`c`, or its constant value.
+        - **species** (str): Name of the regulating species :math:`y`.
+        - **coefficient** (Union[str, float]): Name of the parameter :math:`\alpha`, or its constant value.
+        - **exponent** (Union[str, float]): Name of the Hill exponent :math:`\eta`, or its constant value.
+        - **repression** (bool, optional): If True, the species represses the reaction. If False, it activates it. Defaults to True.
+    """
+    def __init__(self,
+                rate: Union[str, float],
+                species: str,
+                coefficient: Union[str, float],
+                exponent: Union[str, float],
+                repression: bool =True):
+        self.rate = rate
+        self.regulator = species
+        self.coefficient = coefficient
+        self.exponent = exponent
+        self.repression = repression
+
+    def resolve(self, species: list, parameters: list, reaction_reactants: dict):
+        """Converts the names of species and parameters into indices.
+
+        Args:
+            - **species** (list): Names of the species of the network.
+            - **parameters** (list): Names of the parameters of the network.
+            - **reaction_reactants** (dict): Reactants of the reaction the term belongs to. Not used.
+        """
+        self.species_index = species.index(self.regulator)
+        self.species = np.array([self.species_index])
+        self.rate_index, self.rate_constant = _resolve(self.rate, parameters)
+        self.coefficient_index, self.coefficient_constant = _resolve(self.coefficient, parameters)
+        self.exponent_index, self.exponent_constant = _resolve(self.exponent, parameters)
+        self.parameters = {self.rate_index, self.coefficient_index, self.exponent_index} - {None}
+
+    def _terms(self, params: np.ndarray, x: np.ndarray) -> Tuple:
+        c = _get(params, self.rate_index, self.rate_constant)
+        alpha = _get(params, self.coefficient_index, self.coefficient_constant)
+        eta = _get(params, self.exponent_index, self.exponent_constant)
+        y = x[self.species_index]
+        return c, alpha, eta, y, y**eta
+
+    def value(self, params: np.ndarray, x: np.ndarray) -> np.ndarray:
+        """Evaluates the term.
+
+        Args:
+            - **params** (np.ndarray): Parameters of the network.
+            - **x** (np.ndarray): Abundances. ``x[i]`` can either be a scalar or an array.
+        """
+        c, alpha, _, _, y_eta = self._terms(params, x)
+        if self.repression:
+            return c / (1 + alpha*y_eta)
+        return c * alpha*y_eta / (1 + alpha*y_eta)
+
+    def partial(self, params: np.ndarray, x: np.ndarray, j: int) -> np.ndarray:
+        """Evaluates the derivative of the term with respect to the parameter :math:`j`.
+
+        Args:
+            - **params** (np.ndarray): Parameters of the network.
+            - **x** (np.ndarray): Abundances. ``x[i]`` can either be a scalar or an array.
+            - **j** (int): Index of the parameter.
+        """
+        c, alpha, _, y, y_eta = self._terms(params, x)
+        denominator = (1 + alpha*y_eta)**2
+        # derivative of 1/(1 + alpha*y^eta) with respect to alpha*y^eta, the activation being 1 minus the repression
+        sign = -1 if self.repression else 1
+        derivative = 0.
+        if j == self.rate_index:
+            derivative = derivative + (1 if self.repression else alpha*y_eta) / (1 + alpha*y_eta)
+        if j == self.coefficient_index:
+            derivative = derivative + sign * c * y_eta / denominator
+        if j == self.exponent_index:
+            # y^eta log(y) tends to 0 when y tends to 0
+            with np.errstate(divide='ignore', invalid='ignore'):
+                y_eta_log = np.where(y > 0, y_eta * np.log(np.where(y > 0, y, 1)), 0.)
+            derivative = derivative + sign * c * alpha * y_eta_log / denominator
+        return derivative
+
+
+class Reaction:
+    r"""Reaction of a Chemical Reaction Network.
+
+    Args:
+        - **reactants** (dict, optional): Number of molecules consumed by the reaction, indexed by species names. Defaults to None,
+          which means that no molecule is consumed.
+        - **products** (dict, optional): Number of molecules produced by the reaction, indexed by species names. Defaults to None,
+          which means that no molecule is produced.
+        - **rate** (Union[MassAction, Hill, list]): Rate law of the reaction. If it is a list, the propensity is the sum of its terms.
+    """
+    def __init__(self,
+                reactants: dict =None,
+                products: dict =None,
+                rate: Union[MassAction, Hill, list] =None):
+        self.reactants = {} if reactants is None else reactants
+        self.products = {} if products is None else products
+        if rate is None:
+            raise ValueError("The rate law of the reaction must be specified.")
+        self.terms = rate if isinstance(rate, list) else [rate]
+
+
+class ReactionPropensity:
+    r"""Propensity function of a single reaction, or its derivative with respect to a parameter, built from its rate terms.
+    Can be evaluated on a single state or on an array of transposed states.
+
+    Args:
+        - **terms** (list): Rate terms of the reaction.
+        - **param** (int, optional): Index of the parameter to derive the propensity with respect to. If None, computes
+          the propensity itself. Defaults to None.
+    """
+    def __init__(self, terms: list, param: int =None):
+        self.terms = terms
+        self.param = param
+
+    def __call__(self, params: np.ndarray, x: np.ndarray) -> np.ndarray:
+        if self.param is None:
+            return sum(term.value(params, x) for term in self.terms)
+        return sum(term.partial(params, x, self.param) for term in self.terms)
+
+
+class ReactionNetwork:
+    r"""Declarative specification of a Chemical Reaction Network.
+
+    Builds the stoichiometry matrix, the propensity functions and their derivatives with respect to the parameters
+    from a list of reactions. The derivatives are computed in closed form from the rate terms. The result can be used
+    to define a ``simulation.CRN`` with ``simulation.CRN.from_network``.
+
+    For instance, for the toggle switch:
+
+    .. code-block:: python
+
+        network = ReactionNetwork(species=['X', 'Y'],
+                                parameters=['b_x', 'b_y', 'k_x', 'k_y', 'alpha_xy', 'alpha_yx', 'eta_xy', 'eta_yx', 'gamma_x', 'gamma_y'],
+                                reactions=[Reaction(products={'X': 1}, rate=[MassAction('b_x'), Hill('k_x', 'Y', 'alpha_yx', 'eta_yx')]),
+                                            Reaction(reactants={'X': 1}, rate=MassAction('gamma_x')),
+                                            Reaction(products={'Y': 1}, rate=[MassAction('b_y'), Hill('k_y', 'X', 'alpha_xy', 'eta_xy')]),
+                                            Reaction(reactants={'Y': 1}, rate=MassAction('gamma_y'))])
+
+    Args:
+        - **species** (list): Names of the species. Their order defines the order of the abundances in the states.
+        - **parameters** (list): Names of the parameters. Their order defines the order of the parameters of the propensity functions.
+          Fixed parameters :math:`\theta` must come first, followed by control parameters :math:`\xi`.
+        - **reactions** (list): Reactions of the network.
+    """
+    def __init__(self, species: list, parameters: list, reactions: list):
+        self.species = list(species)
+        self.parameters = list(parameters)
+        self.reactions = reactions
+        self.n_species = len(self.species)
+        self.n_reactions = len(reactions)
+        self.n_params = len(self.parameters)
+        self.stoichiometry_mat = np.zeros((self.n_species, self.n_reactions))
+        self.species_dependencies = np.zeros((self.n_reactions, self.n_species), dtype=bool)
+        # True when the derivative of the propensity k with respect to the parameter j is not identically zero
+        self.drv_sparsity = np.zeros((self.n_reactions, self.n_params), dtype=bool)
+        self.highest_orders = np.zeros(self.n_species, dtype=int)
+        for k, reaction in enumerate(reactions):
+            for name, n in reaction.reactants.items():
+                self.stoichiometry_mat[self.species.index(name), k] -= n
+            for name, n in reaction.products.items():
+                self.stoichiometry_mat[self.species.index(name), k] += n
+            for term in reaction.terms:
+                term.resolve(self.species, self.parameters, reaction.reactants)
+                self.species_dependencies[k, term.species] = True
+                self.drv_sparsity[k, list(term.parameters)] = True
+                order = term.orders.sum() if isinstance(term, MassAction) else 1
+                self.highest_orders[term.species] = np.maximum(self.highest_orders[term.species], order)
+        self.propensities = np.array([ReactionPropensity(reaction.terms) for reaction in reactions])
+        self.propensities_drv = np.array([zeros]*(self.n_reactions*self.n_params)).reshape((self.n_reactions, self.n_params))
+        for k, j in zip(*np.nonzero(self.drv_sparsity)):
+            self.propensities_drv[k, j] = ReactionPropensity(reactions[k].terms, j)
+        self._build_kernel()
+
+    def _build_kernel(self):
+        # mass-action terms are gathered to be evaluated with array operations only
+        mass_action = [(k, term) for k, reaction in enumerate(self.reactions) for term in reaction.terms if isinstance(term, MassAction)]
+        self.hill_terms = [(k, term) for k, reaction in enumerate(self.reactions) for term in reaction.terms if isinstance(term, Hill)]
+        self.ma_orders = np.array([term.orders for _, term in mass_action], dtype=int).reshape((len(mass_action), self.n_species))
+        self.ma_reactions = np.zeros((len(mass_action), self.n_reactions))
+        self.ma_rate_index = np.zeros(len(mass_action), dtype=int)
+        self.ma_rate_constant = np.ones(len(mass_action))
+        self.ma_is_param = np.zeros(len(mass_action), dtype=bool)
+        for t, (k, term) in enumerate(mass_action):
+            self.ma_reactions[t, k] = 1
+            if term.rate_index is not None:
+                self.ma_rate_index[t] = term.rate_index
+                self.ma_is_param[t] = True
+            else:
+                self.ma_rate_constant[t] = term.rate_constant
+
+    def vectorized_propensities(self, params: np.ndarray, states: np.ndarray) -> np.ndarray:
+        """Computes the propensities of all reactions for several states at once.
+
+        Args:
+            - **params** (np.ndarray): Parameters associated to the propensity functions.
+            - **states** (np.ndarray): States. Has shape :math:`(n, N)`.
+
+        Returns:
+            - The propensities of each reaction for each state. Has shape :math:`(n, M)`.
+        """
+        states = np.asarray(states, dtype=float)
+        rates = np.where(self.ma_is_param, np.asarray(params, dtype=float)[self.ma_rate_index], self.ma_rate_constant)
+        # falling factorials, for all mass-action terms at once
+        h = np.ones((len(states), len(self.ma_orders)))
+        for o in range(self.ma_orders.max(initial=0)):
+            h *= np.where(self.ma_orders > o, states[:, None, :] - o, 1.).prod(axis=-1)
+        lambdas = (h * rates).dot(self.ma_reactions)
+        x = states.T
+        for k, term in self.hill_terms:
+            lambdas[:, k] += term.value(params, x)
+        return lambdas
@@ -1,5 +1,5 @@
 import numpy as np
-import random
+import math
 from typing import Tuple, Callable, Union
 
 class CRN:
@@ -18,6 +18,19 @@ class CRN:
         - **exact** (Tuple[bool, Tuple[Callable], Tuple[Callable]], optional): If the first element is True, 
           the exact distribution of the CRN is known. The second element then is the exact probability mass function. The third
           element is the exact sensitivities of the mass function. Defaults to (False, None, None).
+        - **species_dependencies** (Union[np.ndarray, str], optional): Boolean array of shape :math:`(M, N)`. Its element :math:`(k, i)` is True
+          if the propensity of the reaction :math:`k` depends on the abundance of the species :math:`i`. If 'probe', it is deduced by probing the
+          propensity functions with ``probe_species_dependencies``, which may miss dependencies. If None, every propensity is considered to 
+          depend on every species. Defaults to None.
+        - **highest_orders** (np.ndarray, optional): Highest order of the reactions in which each species is a reactant. Has shape :math:`(N,)`.
+          Used to select the step size of tau-leaping. If None, all species on which a propensity depends are considered to 
+          be reactants of first-order reactions only. Defaults to None.
+        - **vectorized_propensities** (Callable, optional): Single function computing all propensities for several states at once. 
+          Takes the parameters and an array of states of shape :math:`(n, N)` as inputs and returns an array of shape :math:`(n, M)`. 
+          It must be consistent with **propensities**. If None, it is built from **propensities** as a ``PropensityBundle``. Defaults to None.
+        - **drv_sparsity** (np.ndarray, optional): Boolean array of shape :math:`(M, M_{\theta}+M_{\xi})`. Its element :math:`(k, j)` is False
+          if the derivative of the propensity of the reaction :math:`k` with respect to the parameter :math:`j` is identically zero.
+          If None, all derivatives are considered non zero. Defaults to None.
     """    
     def __init__(self,
                 stoichiometry_mat: np.ndarray, 
@@ -26,17 +39,26 @@ class CRN:
                 n_fixed_params: int,
                 n_control_params: int =0,
                 propensities_drv: np.ndarray =None,
-                exact_distr: Tuple[bool, Tuple[Callable], Tuple[Callable]] =(False, None, None)):
+                exact_distr: Tuple[bool, Tuple[Callable], Tuple[Callable]] =(False, None, None),
+                species_dependencies: Union[np.ndarray, str] =None,
+                highest_orders: np.ndarray =None,
+                vectorized_propensities: Callable =None,
+                drv_sparsity: np.ndarray =None):
         # stoichiometry_mat has shape (n_species, n_reactions)
         self.stoichiometry_mat = stoichiometry_mat
         # total number of reactions, including those whose parameters change
         self.n_species, self.n_reactions = np.shape(stoichiometry_mat)
-        self.sampling_times = np.empty(0)
-        self.sampling_states = np.empty((0, self.n_species))
+        self.trajectory = TrajectoryBuffer(self.n_species)
         self.init_state = init_state
         self.time = 0
         self.current_state = self.init_state.copy()
+        # number of events since t=0 and whether the simulation was stopped by the budgets of `simulation`
+        self.n_events = 0
+        self.capped = False
         self.propensities = propensities
+        if vectorized_propensities is None:
+            vectorized_propensities = PropensityBundle(propensities)
+        self.vectorized_propensities = vectorized_propensities
         self.n_fixed_params = n_fixed_params
         self.n_control_params = n_control_params
         self.exact = exact_distr[0]
@@ -44,6 +66,132 @@ class CRN:
         if exact_distr[0]:
             self.exact_distr = exact_distr[1]
             self.exact_sensitivities_prob = exact_distr[2]
+        if species_dependencies is None:
+            # conservative choice, all propensities are updated after each reaction
+            species_dependencies = np.ones((self.n_reactions, self.n_species), dtype=bool)
+        elif isinstance(species_dependencies, str):
+            if species_dependencies != 'probe':
+                raise ValueError("species_dependencies should be a boolean array, 'probe' or None.")
+            species_dependencies = self.probe_species_dependencies()
+        self.species_dependencies = np.asarray(species_dependencies, dtype=bool)
+        self.dependency_graph = self.create_dependency_graph()
+        if highest_orders is None:
+            highest_orders = self.species_dependencies.any(axis=0).astype(int)
+        self.highest_orders = np.asarray(highest_orders)
+        if drv_sparsity is None:
+            drv_sparsity = np.ones((self.n_reactions, n_fixed_params + n_control_params), dtype=bool)
+        self.drv_sparsity = np.asarray(drv_sparsity, dtype=bool)
+        # built at the first call of `propensities_derivatives`
+        self._drv_bundle = None
+
+    @property
+    def sampling_times(self) -> np.ndarray:
+        """Times of the samples computed since the last reset."""
+        return self.trajectory.times
+
+    @property
+    def sampling_states(self) -> np.ndarray:
+        """Abundance samples computed since the last reset. Has shape :math:`(\text{n_samples}, N)`."""
+        return self.trajectory.states
+
+    @classmethod
+    def from_network(cls,
+                    network,
+                    init_state: np.ndarray,
+                    n_fixed_params: int,
+                    n_control_params: int =0,
+                    exact_distr: Tuple[bool, Tuple[Callable], Tuple[Callable]] =(False, None, None)):
+        r"""Defines a CRN from a declarative specification.
+
+        Args:
+            - **network** (reaction_network.ReactionNetwork): Specification of the reactions of the network.
+            - **init_state** (np.ndarray): Initial state of the system.
+            - **n_fixed_params** (int): Number of fixed parameters :math:`M_{\theta}`.
+            - **n_control_params** (int, optional): Number of control parameters :math:`M_{\xi}`. Defaults to 0.
+            - **exact_distr** (Tuple[bool, Tuple[Callable], Tuple[Callable]], optional): Exact distribution of the CRN, as 
+              defined in the constructor. Defaults to (False, None, None).
+
+        Returns:
+            - The corresponding CRN, with propensity functions, derivatives and dependencies generated from the specification.
+        """
+        if network.n_params != n_fixed_params + n_control_params:
+            raise ValueError(f"The network has {network.n_params} parameters, {n_fixed_params + n_control_params} were expected.")
+        return cls(stoichiometry_mat=network.stoichiometry_mat,
+                    propensities=network.propensities,
+                    init_state=init_state,
+                    n_fixed_params=n_fixed_params,
+                    n_control_params=n_control_params,
+                    propensities_drv=network.propensities_drv,
+                    exact_distr=exact_distr,
+                    species_dependencies=network.species_dependencies,
+                    highest_orders=network.highest_orders,
+                    vectorized_propensities=network.vectorized_propensities,
+                    drv_sparsity=network.drv_sparsity)
+
+    def probe_species_dependencies(self, n_probes: int =5) -> np.ndarray:
+        r"""Deduces which species each propensity function depends on. The propensity of a reaction :math:`k` is considered 
+        to depend on the species :math:`i` if its value changes when the abundance of :math:`i` is modified, for random parameters 
+        and probing states. The probing states are the null state and random states. A dependency which does not show at these 
+        states is missed, in which case the exact simulation algorithms are incorrect: ``species_dependencies`` should then be 
+        given explicitly.
+
+        Args:
+            - :math:`n_{\text{probes}}` (int, optional): Number of probing states. Defaults to :math:`5`.
+
+        Returns:
+            - Boolean array of shape :math:`(M, N)`.
+        """
+        depends = np.zeros((self.n_reactions, self.n_species), dtype=bool)
+        # independent from the global random state
+        rng = np.random.default_rng(0)
+        probes = rng.integers(0, 50, size=(n_probes, self.n_species)).astype(float)
+        probes[0] = 0
+        for x in probes:
+            params = rng.uniform(0.5, 2., size=self.n_fixed_params + self.n_control_params)
+            # the probing state followed by the probing state with one more molecule of each species, evaluated at once
+            states = np.concatenate((x[None, :], x + np.eye(self.n_species)))
+            values = self.vectorized_propensities(params, states)
+            depends |= ~np.isclose(values[1:], values[0], rtol=1e-12, atol=0).T
+        return depends
+
+    def create_dependency_graph(self) -> list:
+        r"""Computes, for each reaction, the reactions whose propensities have to be updated once it has occurred,
+        ie the reactions whose propensities depend on at least one species modified by this reaction.
+
+        Returns:
+            - List of :math:`M` arrays. The :math:`k`-th array contains the indices of the reactions affected by the reaction :math:`k`.
+        """
+        affected = []
+        for k in range(self.n_reactions):
+            changed_species = np.asarray(self.stoichiometry_mat)[:, k] != 0
+            affected.append(np.flatnonzero(self.species_dependencies[:, changed_species].any(axis=1)))
+        return affected
+
+    def propensities_derivatives(self, params: np.ndarray, states: np.ndarray) -> np.ndarray:
+        r"""Computes the derivatives of the propensities with respect to the parameters of a time window for several states at once.
+        If **propensities_drv** is None, the CRN follows mass-action kinetics: the parameter :math:`k` is the rate of the reaction :math:`k`.
+        Only the derivatives which are not identically zero according to **drv_sparsity** are evaluated.
+
+        Args:
+            - **params** (np.ndarray): Parameters of the propensity functions. Has shape :math:`(M_{\theta}+M_{\xi},)`.
+            - **states** (np.ndarray): States. Has shape :math:`(n, N)`.
+
+        Returns:
+            - The derivatives :math:`\frac{\partial \lambda_k}{\partial \theta_j}` for each state. Has shape :math:`(n, M, M_{\theta}+M_{\xi})`.
+        """
+        n_params = self.n_fixed_params + self.n_control_params
+        drv = np.zeros((len(states), self.n_reactions, n_params))
+        if self.propensities_drv is None:
+            # propensities with rates equal to 1
+            diag = np.arange(min(self.n_reactions, n_params))
+            drv[:, diag, diag] = self.vectorized_propensities(np.ones(n_params), states)[:, diag]
+        else:
+            if self._drv_bundle is None:
+                # all derivatives which are not identically zero, evaluated at once
+                self._drv_indices = np.nonzero(self.drv_sparsity)
+                self._drv_bundle = PropensityBundle(np.asarray(self.propensities_drv)[self._drv_indices])
+            drv[:, self._drv_indices[0], self._drv_indices[1]] = self._drv_bundle(params, states)
+        return drv
 
     def step(self, 
             init_state: np.ndarray, 
@@ -52,7 +200,12 @@ class CRN:
             t0: float,
             tf: float,
             method: str,
-            complete_trajectory: bool): 
+            complete_trajectory: bool,
+            rng: np.random.Generator =None,
+            method_options: dict =None,
+            record_every: int =1,
+            max_abundances: np.ndarray =None,
+            max_events: int =None): 
         """Computes a simulation for a time window during which all parameters are constant.
 
         Args:
@@ -64,24 +217,23 @@ class CRN:
             - **method** (str): Stochastic Simulation to compute.
             - **complete_trajectory** (bool): If True, saves the complete trajectory of the simulation, ie the time of each jump and the
               corresponding abundance.
+            - **rng** (np.random.Generator, optional): Random number generator. If None, a generator is created from fresh entropy.
+              Defaults to None.
+            - **method_options** (dict, optional): Keyword arguments of the simulation method, for instance the time step of `CLE`.
+              Defaults to None.
+            - **record_every** (int, optional): When **complete_trajectory** is True, only one jump out of **record_every** is saved, 
+              as well as the state at :math:`t_f`. Defaults to :math:`1`.
+            - **max_abundances** (np.ndarray, optional): Maximal abundance of each species. Has shape :math:`(N,)`. A trajectory whose
+              abundances exceed it is stopped: its state remains the same until the end of the simulation and it is flagged as capped.
+              If None, no maximal abundance. Defaults to None.
+            - **max_events** (int, optional): Maximal number of events of a trajectory, ie of reactions, or of leaps and time steps 
+              for the approximate methods. A trajectory which reaches it is stopped and flagged in the same way. If None, no maximal 
+              number of events. The events of the previous time windows are counted. Defaults to None.
         """
-        set_parameters = np.vectorize(lambda f, params: (lambda x: f(params, x)), excluded=[1])          
-        lambdas = set_parameters(self.propensities, params)
-        simulations = StochasticSimulation(x0=init_state,
-                                            t0=t0,
-                                            tf=tf,
-                                            sampling_times=sampling_times,
-                                            propensities=lambdas,
-                                            n_species=self.n_species,
-                                            n_reactions=self.n_reactions,
-                                            stoich_mat=self.stoichiometry_mat)
-        if method == 'SSA':
-            samples = simulations.SSA(complete_trajectory)
-        else:
-            samples = simulations.mNRM(complete_trajectory)
-        self.sampling_times = np.concatenate((self.sampling_times, simulations.sampling_times))
-        self.sampling_states = np.concatenate((self.sampling_states, samples))
-        self.current_state = simulations.current_state
+        times, samples, self.current_state, self.n_events, self.capped = _simulate_window(self, init_state, params, sampling_times, t0, tf, 
+                                                                                        method, complete_trajectory, rng, method_options, 
+                                                                                        record_every, max_abundances, max_events, self.n_events)
+        self.trajectory.extend(times, samples)
         self.time = tf
 
     def simulation(self, 
@@ -89,7 +241,12 @@ class CRN:
                 time_windows: np.ndarray, 
                 parameters: np.ndarray, 
                 method: str ='SSA', 
-                complete_trajectory: bool =False):
+                complete_trajectory: bool =False,
+                rng: np.random.Generator =None,
+                method_options: dict =None,
+                record_every: int =1,
+                max_abundances: np.ndarray =None,
+                max_events: int =None):
         r"""Computes a simulation between two time points.
 
         Args:
@@ -100,10 +257,29 @@ class CRN:
             - **parameters** (np.ndarray): Parameters of the simulation, including fixed parameters for the whole simulation and control
               parameters for each time window. Its form is :math:`[\theta_1, ..., \theta_{M_{\theta}}, \xi_1^1, ..., \xi^{M_{\xi}}_1, \xi_2^1, ..., \xi_L^{M_{\xi}}]`.
               Has shape :math:`(M_{\tot},)`.
-            - **method** (str, optional): Stochastic Simulation to compute. Defaults to `SSA`.
+            - **method** (str, optional): Stochastic Simulation to compute. Either `SSA` for the Stochastic Simulation Algorithm, `SSA-CR`
+              for its composition-rejection variant, `mNRM` for the modified Next Reaction Method, `tau-leap` for the approximate 
+              tau-leaping method, `CLE` for the Chemical Langevin Equation or `hybrid` for the hybrid continuous-discrete method. 
+              The last three are suited to high abundances. Defaults to `SSA`.
             - **complete_trajectory** (bool, optional): If True, saves the complete trajectory of the simulation, ie the time of each jump and the
               corresponding abundance. Defaults to False.
+            - **rng** (np.random.Generator, optional): Random number generator, used for all time windows. If None, a generator is 
+              created from fresh entropy. Defaults to None.
+            - **method_options** (dict, optional): Keyword arguments of the simulation method, for instance ``{'dt': 0.01}`` 
+              for `CLE`. See ``StochasticSimulation``. Defaults to None.
+            - **record_every** (int, optional): When **complete_trajectory** is True, only one jump out of **record_every** is saved, 
+              as well as the state at the end of each time window. To record the abundances on a uniform time grid instead, 
+              set **complete_trajectory** to False and use the grid as **sampling_times**. Defaults to :math:`1`.
+            - **max_abundances** (np.ndarray, optional): Maximal abundance of each species. Has shape :math:`(N,)`. A trajectory whose
+              abundances exceed it is stopped: its state remains the same until the end of the simulation and it is flagged as capped.
+              If None, no maximal abundance. Defaults to None.
+            - **max_events** (int, optional): Maximal number of events of a trajectory, ie of reactions, or of leaps and time steps 
+              for the approximate methods. A trajectory which reaches it is stopped and flagged in the same way. If None, no maximal 
+              number of events. Defaults to None. Whether the simulation was stopped can be found in the attribute **capped**, 
+              so that the worst-case simulation time of unbounded networks is bounded.
         """       
+        if rng is None:
+            rng = np.random.default_rng()
         # time_windows [t1, ..., tf] with t0 = 0
         for i, t in enumerate(time_windows):
             self.step(init_state=self.current_state, 
@@ -112,7 +288,88 @@ class CRN:
                         t0=self.time,
                         tf=t,
                         method=method,
-                        complete_trajectory=complete_trajectory)
+                        complete_trajectory=complete_trajectory,
+                        rng=rng,
+                        method_options=method_options,
+                        record_every=record_every,
+                        max_abundances=max_abundances,
+                        max_events=max_events)
+
+    def ensemble_simulation(self,
+                            sampling_times: np.ndarray,
+                            time_windows: np.ndarray,
+                            parameters: np.ndarray,
+                            n_trajectories: int,
+                            method: str ='SSA',
+                            rng: np.random.Generator =None,
+                            method_options: dict =None,
+                            max_abundances: np.ndarray =None,
+                            max_events: int =None) -> Union[np.ndarray, Tuple[np.ndarray]]:
+        r"""Computes :math:`n_{\text{trajectories}}` independent simulations at once, all trajectories being advanced in lockstep.
+        Does not modify the current state of the CRN: all trajectories start from the initial state at :math:`t=0`.
+
+        Args:
+            - **sampling_times** (np.ndarray): Sampling times.
+            - **time_windows** (np.ndarray): Time windows during which all parameters are constant. Its form is :math:`[t_1, ..., t_L]`,
+              such that the time windows are :math:`[0, t_1], [t_1, t_2], ..., [t_{L-1}, t_L]`. :math:`t_L` must match
+              with the final time :math:`t_f`. If there is only one time window, it should be defined as :math:`[t_f]`.
+            - **parameters** (np.ndarray): Parameters of the simulation for each time window. Has shape :math:`(L, M_{\theta}+M_{\xi})`.
+            - :math:`n_{\text{trajectories}}` (int): Number of trajectories to compute.
+            - **method** (str, optional): Stochastic Simulation to compute. Either `SSA` or `CLE`. Defaults to `SSA`.
+            - **rng** (np.random.Generator, optional): Random number generator. If None, a generator is created from fresh entropy.
+              Defaults to None.
+            - **method_options** (dict, optional): Keyword arguments of the simulation method, for instance ``{'dt': 0.01}`` 
+              for `CLE`. Defaults to None.
+            - **max_abundances** (np.ndarray, optional): Maximal abundance of each species. Has shape :math:`(N,)`. A trajectory whose
+              abundances exceed it is stopped: its state remains the same until the end of the simulation and it is flagged as capped.
+              If None, no maximal abundance. Defaults to None.
+            - **max_events** (int, optional): Maximal number of events of a trajectory, ie of reactions, or of leaps and time steps 
+              for the approximate methods. A trajectory which reaches it is stopped and flagged in the same way. If None, no maximal 
+              number of events. Defaults to None.
+
+        Returns:
+            - **samples**: Abundance samples at the sampling times strictly greater than :math:`0`.
+              Has shape :math:`(n_{\text{trajectories}}, \text{n_sampling_times}, N)`.
+            - **capped**: Only if **max_abundances** or **max_events** is specified. Boolean array of shape :math:`(n_{\text{trajectories}},)`,
+              True for the trajectories which were stopped.
+        """
+        if method not in ['SSA', 'CLE']:
+            raise ValueError(f"Method {method} is not available for ensemble simulations.")
+        options = {} if method_options is None else method_options
+        if rng is None:
+            rng = np.random.default_rng()
+        states = np.tile(np.asarray(self.init_state, dtype=float), (n_trajectories, 1))
+        n_events = np.zeros(n_trajectories, dtype=np.int64)
+        capped = np.zeros(n_trajectories, dtype=bool)
+        samples = [np.zeros((n_trajectories, 0, self.n_species))]
+        time = 0
+        for i, t in enumerate(time_windows):
+            simulations = EnsembleSimulation(x0=states,
+                                            t0=time,
+                                            tf=t,
+                                            sampling_times=sampling_times[(sampling_times > time) & (sampling_times <= t)],
+                                            propensities=self.propensities,
+                                            params=parameters[i,:],
+                                            vectorized_propensities=self.vectorized_propensities,
+                                            n_species=self.n_species,
+                                            n_reactions=self.n_reactions,
+                                            stoich_mat=self.stoichiometry_mat,
+                                            dependency_graph=self.dependency_graph,
+                                            rng=rng,
+                                            max_abundances=max_abundances,
+                                            max_events=max_events,
+                                            n_events=n_events)
+            if method == 'SSA':
+                samples.append(simulations.SSA(**options))
+            else:
+                samples.append(simulations.CLE(**options))
+            states = simulations.current_state
+            n_events = simulations.n_events
+            capped = simulations.capped
+            time = t
+        if max_abundances is None and max_events is None:
+            return np.concatenate(samples, axis=1)
+        return np.concatenate(samples, axis=1), capped
 
     def reset(self):
         """Resets the CRN to the initial setting: sets the time to :math:`t=0`, the current state to the initial state and
@@ -120,24 +377,539 @@ class CRN:
         """
         self.time = 0
         self.current_state = self.init_state.copy()
-        self.sampling_times = np.empty(0)                   
-        self.sampling_states = np.empty((0, self.n_species))
+        self.n_events = 0
+        self.capped = False
+        self.trajectory = TrajectoryBuffer(self.n_species)
+
+
+
+def _simulate_window(crn: CRN,
+                    init_state: np.ndarray,
+                    params: np.ndarray,
+                    sampling_times: np.ndarray,
+                    t0: float,
+                    tf: float,
+                    method: str,
+                    complete_trajectory: bool,
+                    rng: np.random.Generator,
+                    method_options: dict,
+                    record_every: int =1,
+                    max_abundances: np.ndarray =None,
+                    max_events: int =None,
+                    n_events: int =0) -> Tuple:
+    # simulation of a single time window, which only reads the CRN
+    # returns the times, the samples, the final state, the number of events since t=0 and whether the trajectory was stopped
+    options = {} if method_options is None else method_options
+    simulations = StochasticSimulation(x0=init_state,
+                                        t0=t0,
+                                        tf=tf,
+                                        sampling_times=sampling_times,
+                                        propensities=crn.propensities,
+                                        params=params,
+                                        vectorized_propensities=crn.vectorized_propensities,
+                                        n_species=crn.n_species,
+                                        n_reactions=crn.n_reactions,
+                                        stoich_mat=crn.stoichiometry_mat,
+                                        dependency_graph=crn.dependency_graph,
+                                        highest_orders=crn.highest_orders,
+                                        rng=rng,
+                                        record_every=record_every,
+                                        max_abundances=max_abundances,
+                                        max_events=max_events,
+                                        n_events=n_events)
+    if method == 'SSA':
+        samples = simulations.SSA(complete_trajectory, **options)
+    elif method == 'mNRM':
+        samples = simulations.mNRM(complete_trajectory, **options)
+    elif method == 'SSA-CR':
+        samples = simulations.SSA_CR(complete_trajectory, **options)
+    elif method == 'tau-leap':
+        samples = simulations.tau_leap(complete_trajectory, **options)
+    elif method == 'CLE':
+        samples = simulations.CLE(complete_trajectory, **options)
+    elif method == 'hybrid':
+        samples = simulations.hybrid(complete_trajectory, **options)
+    else:
+        raise ValueError(f"Unknown simulation method {method}.")
+    return simulations.sampling_times, samples, simulations.current_state, simulations.n_events, simulations.capped
+
+
+def simulate(crn: CRN,
+            sampling_times: np.ndarray,
+            time_windows: np.ndarray,
+            parameters: np.ndarray,
+            rng: np.random.Generator =None,
+            method: str ='SSA',
+            complete_trajectory: bool =False,
+            method_options: dict =None,
+            record_every: int =1,
+            max_abundances: np.ndarray =None,
+            max_events: int =None) -> Tuple[np.ndarray]:
+    r"""Computes a simulation from the initial state of a CRN at :math:`t=0`, without modifying the CRN. 
+    
+    Unlike ``CRN.simulation``, it does not use nor update the current state of the CRN, so that the same CRN can be used 
+    from several threads at once and no reset is needed between simulations.
+
+    Args:
+        - **crn** (CRN): CRN to simulate. Only read.
+        - **sampling_times** (np.ndarray): Sampling times.
+        - **time_windows** (np.ndarray): Time windows during which all parameters are constant. Its form is :math:`[t_1, ..., t_L]`,
+          such that the time windows are :math:`[0, t_1], [t_1, t_2], ..., [t_{L-1}, t_L]`. :math:`t_L` must match
+          with the final time :math:`t_f`. If there is only one time window, it should be defined as :math:`[t_f]`.
+        - **parameters** (np.ndarray): Parameters of the simulation for each time window. Has shape :math:`(L, M_{\theta}+M_{\xi})`.
+        - **rng** (np.random.Generator, optional): Random number generator. If None, a generator is created from fresh entropy.
+          Defaults to None.
+        - **method** (str, optional): Stochastic Simulation to compute, as defined in ``CRN.simulation``. Defaults to `SSA`.
+        - **complete_trajectory** (bool, optional): If True, returns the complete trajectory of the simulation, ie the time of each 
+          jump and the corresponding abundance. Defaults to False.
+        - **method_options** (dict, optional): Keyword arguments of the simulation method. Defaults to None.
+        - **record_every** (int, optional): When **complete_trajectory** is True, only one jump out of **record_every** is saved, 
+          as well as the state at the end of each time window. Defaults to :math:`1`.
+        - **max_abundances** (np.ndarray, optional): Maximal abundance of each species. Has shape :math:`(N,)`. A trajectory whose
+          abundances exceed it is stopped: its state remains the same until the end of the simulation and it is flagged as capped.
+          If None, no maximal abundance. Defaults to None.
+        - **max_events** (int, optional): Maximal number of events of a trajectory, ie of reactions, or of leaps and time steps 
+          for the approximate methods. A trajectory which reaches it is stopped and flagged in the same way. If None, no maximal 
+          number of events. Defaults to None.
+
+    Returns:
+        - **times**: Sampling times strictly greater than :math:`0`, or jump times if **complete_trajectory** is True.
+        - **samples**: Corresponding abundances. Has shape :math:`(\text{n_samples}, N)`.
+        - **capped**: Only if **max_abundances** or **max_events** is specified. True if the trajectory was stopped.
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    trajectory = TrajectoryBuffer(crn.n_species)
+    state = crn.init_state
+    n_events = 0
+    capped = False
+    time = 0
+    for i, t in enumerate(time_windows):
+        times, samples, state, n_events, capped = _simulate_window(crn, state, parameters[i,:], sampling_times[(sampling_times > time) & (sampling_times <= t)], 
+                                                                    time, t, method, complete_trajectory, rng, method_options, 
+                                                                    record_every, max_abundances, max_events, n_events)
+        trajectory.extend(times, samples)
+        time = t
+    if max_abundances is None and max_events is None:
+        return trajectory.times, trajectory.states
+    return trajectory.times, trajectory.states, capped
+
+
+def likelihood_ratio_simulate(crn: CRN,
+                            sampling_times: np.ndarray,
+                            time_windows: np.ndarray,
+                            parameters: np.ndarray,
+                            rng: np.random.Generator =None) -> Tuple[np.ndarray]:
+    r"""Computes a SSA trajectory from the initial state of a CRN at :math:`t=0` together with the score of the path, ie the 
+    derivative of its log-likelihood with respect to all parameters :math:`[\theta_1, ..., \theta_{M_{\theta}}, \xi_1^1, ..., \xi_L^{M_{\xi}}]`.
+    If the :math:`i`-th reaction :math:`k_i` occurs at time :math:`\tau_i` in the state :math:`X_{\tau_i^-}`:
+
+    .. math::
+
+        S_j(t) = \sum_{\tau_i \leq t} \frac{\partial_j \lambda_{k_i}(X_{\tau_i^-})}{\lambda_{k_i}(X_{\tau_i^-})} 
+        - \int_0^t \sum_{k=1}^M \partial_j \lambda_k(X_s)ds
+
+    so that :math:`\partial_j p(x, t) = E[\mathbb{1}_{X_t = x}S_j(t)]` (likelihood ratio method). Does not modify the CRN.
+
+    Args:
+        - **crn** (CRN): CRN to simulate. Only read.
+        - **sampling_times** (np.ndarray): Sampling times.
+        - **time_windows** (np.ndarray): Time windows during which all parameters are constant. Its form is :math:`[t_1, ..., t_L]`,
+          such that the time windows are :math:`[0, t_1], [t_1, t_2], ..., [t_{L-1}, t_L]`. :math:`t_L` must match
+          with the final time :math:`t_f`. If there is only one time window, it should be defined as :math:`[t_f]`.
+        - **parameters** (np.ndarray): Parameters of the simulation for each time window. Has shape :math:`(L, M_{\theta}+M_{\xi})`.
+        - **rng** (np.random.Generator, optional): Random number generator. If None, a generator is created from fresh entropy.
+          Defaults to None.
+
+    Returns:
+        - **samples**: Abundances at the sampling times strictly greater than :math:`0`. Has shape :math:`(\text{n_samples}, N)`.
+        - **scores**: Scores at the same sampling times. Has shape :math:`(\text{n_samples}, M_{\text{tot}})`.
+    """
+    random = RandomStream(rng)
+    sampling_times = sampling_times[sampling_times > 0]
+    n_samples = len(sampling_times)
+    stoich_mat = np.asarray(crn.stoichiometry_mat).astype(np.int64)
+    n_total_params = crn.n_fixed_params + crn.n_control_params*len(time_windows)
+    samples = np.empty((n_samples, crn.n_species), dtype=np.int64)
+    scores = np.zeros((n_samples, n_total_params))
+    state = np.asarray(crn.init_state).astype(np.int64)
+    score = np.zeros(n_total_params)
+    time = 0
+    i_sample = 0
+    for l, t in enumerate(time_windows):
+        params = parameters[l,:]
+        # indices of the parameters of the time window among all parameters
+        columns = np.concatenate((np.arange(crn.n_fixed_params), crn.n_fixed_params + l*crn.n_control_params + np.arange(crn.n_control_params)))
+        while True:
+            lambdas = crn.vectorized_propensities(params, state[None, :])[0]
+            drv = crn.propensities_derivatives(params, state[None, :])[0]
+            total_drv = drv.sum(axis=0)
+            lambda0 = lambdas.sum()
+            end = time + random.exponential() / lambda0 if lambda0 > 0 else np.inf
+            # sampling before the jump
+            while i_sample < n_samples and sampling_times[i_sample] < end and sampling_times[i_sample] <= t:
+                samples[i_sample] = state
+                scores[i_sample] = score
+                scores[i_sample, columns] -= (sampling_times[i_sample] - time)*total_drv
+                i_sample += 1
+            if end > t:
+                score[columns] -= (t - time)*total_drv
+                time = t
+                break
+            cumulated_lambdas = np.cumsum(lambdas)
+            ind_reaction = np.searchsorted(cumulated_lambdas, random.uniform()*lambda0, side='right')
+            score[columns] += drv[ind_reaction] / lambdas[ind_reaction] - (end - time)*total_drv
+            state += stoich_mat[:, ind_reaction]
+            time = end
+    # sampling times after the final time
+    samples[i_sample:] = state
+    scores[i_sample:] = score
+    return samples, scores
+
+
+class PropensityBundle:
+    r"""Vectorised function computing the propensities of all reactions for several states at once, 
+    built from the propensity functions of each reaction.
+
+    Each propensity function is called once for all states, with the transposed array of states of shape :math:`(N, n)`, 
+    so that ``x[i]`` is the vector of abundances of the species :math:`i` for all states. Propensity functions which cannot 
+    be evaluated on arrays are evaluated state by state.
+
+    Args:
+        - **propensities** (np.ndarray): Non-parameterised propensity functions.
+    """
+    def __init__(self, propensities: np.ndarray):
+        self.propensities = propensities
+
+    def __call__(self, params: np.ndarray, states: np.ndarray) -> np.ndarray:
+        """Computes the propensities.
+
+        Args:
+            - **params** (np.ndarray): Parameters associated to the propensity functions.
+            - **states** (np.ndarray): States. Has shape :math:`(n, N)`.
+
+        Returns:
+            - The propensities of each reaction for each state. Has shape :math:`(n, M)`.
+        """
+        states = np.asarray(states, dtype=float)
+        lambdas = np.empty((len(states), len(self.propensities)))
+        x = states.T
+        for k, f in enumerate(self.propensities):
+            try:
+                # broadcasting for the propensities which do not depend on the state
+                lambdas[:, k] = f(params, x)
+            except (ValueError, TypeError):
+                lambdas[:, k] = [f(params, state) for state in states]
+        return lambdas
+
+
+class IndexedPriorityQueue:
+    r"""Binary heap whose elements are indexed by the reactions, so that the value of any reaction can be updated
+    in :math:`O(\log M)` operations. Used by the modified Next Reaction Method to find the next reaction to fire.
+
+    Args:
+        - **values** (np.ndarray): Initial value of each element. Has shape :math:`(M,)`.
+    """
+    def __init__(self, values: np.ndarray):
+        self.values = np.array(values, dtype=float)
+        n = len(self.values)
+        # heap[i] is the element stored at node i, position[k] is the node where the element k is stored
+        self.heap = list(np.argsort(self.values, kind='stable'))
+        self.position = [0]*n
+        for i, k in enumerate(self.heap):
+            self.position[k] = i
+
+    def top(self) -> Tuple[int, float]:
+        """Returns the element with the smallest value and its value."""
+        k = self.heap[0]
+        return k, self.values[k]
+
+    def update(self, k: int, value: float):
+        """Changes the value of an element and restores the heap property.
+
+        Args:
+            - **k** (int): Index of the element.
+            - **value** (float): New value of the element.
+        """
+        old_value = self.values[k]
+        self.values[k] = value
+        if value < old_value:
+            self._sift_up(self.position[k])
+        else:
+            self._sift_down(self.position[k])
+
+    def _swap(self, i: int, j: int):
+        self.heap[i], self.heap[j] = self.heap[j], self.heap[i]
+        self.position[self.heap[i]] = i
+        self.position[self.heap[j]] = j
+
+    def _sift_up(self, i: int):
+        while i > 0:
+            parent = (i - 1) // 2
+            if self.values[self.heap[i]] >= self.values[self.heap[parent]]:
+                break
+            self._swap(i, parent)
+            i = parent
+
+    def _sift_down(self, i: int):
+        n = len(self.heap)
+        while True:
+            smallest = i
+            for child in (2*i + 1, 2*i + 2):
+                if child < n and self.values[self.heap[child]] < self.values[self.heap[smallest]]:
+                    smallest = child
+            if smallest == i:
+                break
+            self._swap(i, smallest)
+            i = smallest
+
+
+class PropensityBins:
+    r"""Reactions grouped into bins of propensities :math:`[2^{g-1}, 2^g)`, as in the composition-rejection method
+    :cite:`slepoy2008constant`. A bin is chosen with probability proportional to the sum of its propensities, then a reaction 
+    is accepted within the bin by rejection sampling with the bound :math:`2^g`, which succeeds with probability at least :math:`1/2`.
+    The number of operations depends on the number of bins only, ie on the range of the propensities, and not on 
+    the number of reactions.
+
+    Args:
+        - **values** (np.ndarray): Initial propensities. Has shape :math:`(M,)`.
+    """
+    def __init__(self, values: np.ndarray):
+        self.values = [0.]*len(values)
+        # bin of each reaction (None for zero propensities) and position of the reaction in its bin
+        self.bin = [None]*len(values)
+        self.position = [0]*len(values)
+        self.members = {}
+        self.sums = {}
+        self.total = 0.
+        for k, value in enumerate(values):
+            self.update(k, float(value))
+
+    def update(self, k: int, value: float):
+        """Changes the propensity of a reaction and moves it to the corresponding bin.
+
+        Args:
+            - **k** (int): Index of the reaction.
+            - **value** (float): New propensity.
+        """
+        g = math.frexp(value)[1] if value > 0 else None
+        old_g = self.bin[k]
+        if old_g is not None:
+            self.sums[old_g] -= self.values[k]
+        self.total += value - self.values[k]
+        self.values[k] = value
+        if g != old_g:
+            if old_g is not None:
+                # the last member of the bin takes the place of the reaction
+                members = self.members[old_g]
+                last = members.pop()
+                if last != k:
+                    members[self.position[k]] = last
+                    self.position[last] = self.position[k]
+                if not members:
+                    del self.members[old_g], self.sums[old_g]
+            if g is not None:
+                members = self.members.setdefault(g, [])
+                self.position[k] = len(members)
+                members.append(k)
+                self.sums.setdefault(g, 0.)
+            self.bin[k] = g
+        if g is not None:
+            self.sums[g] += value
+        elif not self.members:
+            self.total = 0.
+
+    def recompute(self):
+        """Recomputes the sums of the bins, to avoid the accumulation of rounding errors."""
+        for g, members in self.members.items():
+            self.sums[g] = math.fsum(self.values[k] for k in members)
+        self.total = math.fsum(self.sums.values())
+
+    def select(self, random: 'RandomStream') -> int:
+        """Chooses a reaction with probability proportional to its propensity.
+
+        Args:
+            - **random** (RandomStream): Random variates.
+
+        Returns:
+            - Index of the chosen reaction.
+        """
+        # composition: choosing the bin
+        threshold = random.uniform()*self.total
+        for g, partial_sum in self.sums.items():
+            threshold -= partial_sum
+            if threshold < 0:
+                break
+        members = self.members[g]
+        bound = math.ldexp(1., g)
+        # rejection: choosing the reaction within the bin
+        while True:
+            r = random.uniform()*len(members)
+            k = members[int(r)]
+            # the fractional part of r is uniform and independent of the chosen member
+            if (r - int(r))*bound < self.values[k]:
+                return k
+
+
+class RandomStream:
+    r"""Scalar random variates drawn in blocks from a random number generator, which is much cheaper than drawing 
+    them one at a time.
+
+    Args:
+        - **rng** (np.random.Generator, optional): Random number generator. If None, a generator is created from fresh entropy.
+          Defaults to None.
+        - **block_size** (int, optional): Number of variates drawn at once. Defaults to :math:`1024`.
+    """
+    def __init__(self, rng: np.random.Generator =None, block_size: int =1024):
+        self.rng = np.random.default_rng() if rng is None else rng
+        self.block_size = block_size
+        self._exponentials = []
+        self._uniforms = []
+
+    def exponential(self) -> float:
+        """Returns a variate of the exponential distribution of rate :math:`1`."""
+        if not self._exponentials:
+            # popped from the end
+            self._exponentials = self.rng.standard_exponential(self.block_size).tolist()
+        return self._exponentials.pop()
+
+    def uniform(self) -> float:
+        """Returns a variate of the uniform distribution over :math:`[0, 1)`."""
+        if not self._uniforms:
+            self._uniforms = self.rng.random(self.block_size).tolist()
+        return self._uniforms.pop()
+
+
+class PoissonClocks:
+    r"""Independent unit-rate Poisson processes :math:`Y_k`, one for each reaction, of the random time change representation
+    
+    .. math::
+
+        X(t) = X(0) + \sum_{k=1}^M Y_k\left(\int_0^t \lambda_k(X_s)ds\right)\zeta_k
+
+    where :math:`\zeta_k` is the stoichiometry vector of the reaction :math:`k`. Used by the modified Next Reaction Method 
+    :cite:`anderson2007modified`. Each process draws from its own random number generator, so that simulations with different 
+    parameters driven by clocks built from the same seeds use the same random numbers for each reaction (common random numbers).
+    The internal times and the next firing times are kept from one time window to the next.
+
+    Args:
+        - **rngs** (list): Random number generators, one for each reaction.
+        - **block_size** (int, optional): Number of variates drawn at once from each generator. Defaults to :math:`64`.
+    """
+    def __init__(self, rngs: list, block_size: int =64):
+        self.streams = [RandomStream(rng, block_size) for rng in rngs]
+        # internal times T_k and times P_k of the next firings in the unit-rate processes
+        self.internal_times = np.zeros(len(rngs))
+        self.next_firings = np.array([stream.exponential() for stream in self.streams])
+
+    @classmethod
+    def from_seed(cls, seed: np.random.SeedSequence, n_reactions: int):
+        """Builds the clocks from a seed sequence, from which an independent generator is derived for each reaction.
+
+        Args:
+            - **seed** (np.random.SeedSequence): Seed sequence. The same seed sequence always gives the same clocks.
+            - **n_reactions** (int): Number of reactions :math:`M`.
+        """
+        # spawn keys are given explicitly, so that the seed sequence can be used several times
+        children = [np.random.SeedSequence(seed.entropy, spawn_key=seed.spawn_key + (k,)) for k in range(n_reactions)]
+        return cls([np.random.default_rng(child) for child in children])
+
+
+class TrajectoryBuffer:
+    r"""Growable arrays of times and integer abundances. The capacity is doubled whenever it is reached, so that
+    recording a sample has an amortised constant cost.
+
+    Args:
+        - **n_species** (int): Number of species :math:`N`.
+        - **capacity** (int, optional): Initial number of samples which can be stored. Defaults to :math:`16`.
+    """
+    def __init__(self, n_species: int, capacity: int =16):
+        self._times = np.empty(capacity)
+        self._states = np.empty((capacity, n_species), dtype=np.int64)
+        self.size = 0
 
+    def __len__(self) -> int:
+        return self.size
+
+    def _reserve(self, n: int):
+        # makes room for n more samples
+        if self.size + n > len(self._times):
+            capacity = max(2*len(self._times), self.size + n)
+            times = np.empty(capacity)
+            states = np.empty((capacity, self._states.shape[1]), dtype=np.int64)
+            times[:self.size] = self._times[:self.size]
+            states[:self.size] = self._states[:self.size]
+            self._times, self._states = times, states
+
+    def append(self, time: float, state: np.ndarray):
+        """Records a single sample.
+
+        Args:
+            - **time** (float): Time of the sample.
+            - **state** (np.ndarray): Abundances. Has shape :math:`(N,)`.
+        """
+        self._reserve(1)
+        self._times[self.size] = time
+        self._states[self.size] = state
+        self.size += 1
+
+    def extend(self, times: np.ndarray, states: np.ndarray):
+        r"""Records several samples at once.
+
+        Args:
+            - **times** (np.ndarray): Times of the samples. Has shape :math:`(n,)`.
+            - **states** (np.ndarray): Abundances. Has shape :math:`(n, N)`, or :math:`(N,)` when the abundances are the same for all samples.
+        """
+        n = len(times)
+        self._reserve(n)
+        self._times[self.size:self.size+n] = times
+        self._states[self.size:self.size+n] = states
+        self.size += n
+
+    @property
+    def times(self) -> np.ndarray:
+        """View of the recorded times."""
+        return self._times[:self.size]
+
+    @property
+    def states(self) -> np.ndarray:
+        """View of the recorded abundances. Has shape :math:`(\text{n_samples}, N)`."""
+        return self._states[:self.size]
 
 
 class StochasticSimulation: 
     """
-    Class to run a simulation between two time points of the same time window using the Stochastic Simulation Algorithm :cite:`gillespie1976general`.
+    Class to run a simulation between two time points of the same time window using the Stochastic Simulation Algorithm :cite:`gillespie1976general`,
+    its composition-rejection variant :cite:`slepoy2008constant`, the modified Next Reaction Method :cite:`anderson2007modified`,
+    tau-leaping :cite:`cao2006efficient`, the Chemical Langevin Equation :cite:`gillespie2000chemical` or a hybrid 
+    method :cite:`salis2005accurate`.
     
     Args:
         - :math:`x_0` (np.ndarray): Initial state.
         - :math:`t_0` (float): Initial time of the simulation.
         - :math:`t_f` (float): Final time of the simulation.
         - **sampling_times** (np.ndarray): Sampling times.
-        - **propensities** (np.ndarray): Parameterised propensity functions.
+        - **propensities** (np.ndarray): Non-parameterised propensity functions.
+        - **params** (np.ndarray): Parameters associated to the propensity functions.
+        - **vectorized_propensities** (Callable): Function computing all propensities at once, as defined in ``CRN``.
         - **n_species** (int): Number of species involved :math:`N`.
         - **n_reactions** (int): Number of reactions of the CRN :math:`M`.
         - **stoich_mat** (np.ndarray): Stoichiometry matrix.     
+        - **dependency_graph** (list, optional): For each reaction, indices of the reactions whose propensities have to be 
+          updated once it has occurred. If None, all propensities are updated after each reaction. Defaults to None.
+        - **highest_orders** (np.ndarray, optional): Highest order of the reactions in which each species is a reactant. 
+          Used by tau-leaping only. If None, all species are considered to be reactants of first-order reactions. Defaults to None.
+        - **rng** (np.random.Generator, optional): Random number generator. If None, a generator is created from fresh entropy.
+          Defaults to None.
+        - **record_every** (int, optional): When the complete trajectory is computed, only one jump out of **record_every** 
+          is saved, as well as the state at :math:`t_f`, so that the size of the trajectory is bounded. Defaults to :math:`1`.
+        - **max_abundances** (np.ndarray, optional): Maximal abundance of each species. Has shape :math:`(N,)`. A trajectory whose
+          abundances exceed it is stopped: its state remains the same until the end of the simulation and it is flagged as capped.
+          If None, no maximal abundance. Defaults to None.
+        - **max_events** (int, optional): Maximal number of events of a trajectory, ie of reactions, or of leaps and time steps 
+          for the approximate methods. A trajectory which reaches it is stopped and flagged in the same way. If None, no maximal 
+          number of events. Defaults to None.
+        - **n_events** (int, optional): Number of events which already occurred in the previous time windows. Defaults to :math:`0`.
     """   
     def __init__(self,
                 x0: np.ndarray,
@@ -145,19 +917,87 @@ class StochasticSimulation:
                 tf: float, 
                 sampling_times: np.ndarray, 
                 propensities: np.ndarray, 
+                params: np.ndarray,
+                vectorized_propensities: Callable,
                 n_species: int, 
                 n_reactions: int, 
-                stoich_mat: np.ndarray):
+                stoich_mat: np.ndarray,
+                dependency_graph: list =None,
+                highest_orders: np.ndarray =None,
+                rng: np.random.Generator =None,
+                record_every: int =1,
+                max_abundances: np.ndarray =None,
+                max_events: int =None,
+                n_events: int =0):
+        if record_every < 1:
+            raise ValueError('record_every should be a positive integer.')
         self.final_time = tf
         self.n_species = n_species
         self.n_reactions = n_reactions
         self.time = t0
-        self.samples = []
-        self.sampling_times = sampling_times # = np.empty(0) when complete_trajectory=True
-        self.current_state = x0
+        self.sampling_times = sampling_times
+        # abundances are integers
+        self.current_state = np.asarray(x0).astype(np.int64)
+        self.trajectory = TrajectoryBuffer(n_species, capacity=max(len(sampling_times), 16))
         self.propensities = propensities
-        self.stoich_mat = stoich_mat
+        self.params = params
+        self.vectorized_propensities = vectorized_propensities
+        self.stoich_mat = np.asarray(stoich_mat).astype(np.int64)
+        if dependency_graph is None:
+            dependency_graph = [np.arange(n_reactions)]*n_reactions
+        self.dependency_graph = dependency_graph
+        if highest_orders is None:
+            highest_orders = np.ones(n_species, dtype=int)
+        self.highest_orders = highest_orders
+        self.random = RandomStream(rng)
+        self.record_every = record_every
+        # number of jumps not saved since the last saved jump
+        self._unsaved_jumps = 0
+        # budgets are only checked when specified
+        self.check_caps = max_abundances is not None or max_events is not None
+        self.max_abundances = np.full(n_species, np.inf) if max_abundances is None else np.asarray(max_abundances)
+        self.max_events = np.inf if max_events is None else max_events
+        self.n_events = n_events
+        self.capped = False
+
+    def eval_propensities(self) -> np.ndarray:
+        """Evaluates all propensity functions at the current state.
+
+        Returns:
+            - The propensities of each reaction. Has shape :math:`(M,)`.
+        """
+        return self.vectorized_propensities(self.params, self.current_state[None, :])[0]
+
+    def _exceeds_caps(self) -> bool:
+        # a stopped trajectory keeps its state until the final time
+        if self.n_events >= self.max_events or (self.current_state > self.max_abundances).any():
+            self.capped = True
+        return self.capped
 
+    def _save_samples(self, time: float):
+        # saves the current state for all sampling times passed before the given time
+        n_saved = len(self.trajectory)
+        if n_saved == len(self.sampling_times) or self.sampling_times[n_saved] >= time:
+            # no sampling time passed, which is the case for most events
+            return
+        current_index = int(np.searchsorted(self.sampling_times, time, side='left'))
+        self.trajectory.extend(self.sampling_times[len(self.trajectory):current_index], self.current_state)
+
+    def _save_last_samples(self, complete_trajectory: bool):
+        if not(complete_trajectory):
+            # last samples
+            self.trajectory.extend(self.sampling_times[len(self.trajectory):], self.current_state)
+        else:
+            if len(self.trajectory) == 0 or self._unsaved_jumps > 0:
+                self.trajectory.append(self.final_time, self.current_state)
+            # jump times
+            self.sampling_times = self.trajectory.times
+
+    def _save_jump(self):
+        self._unsaved_jumps += 1
+        if self._unsaved_jumps == self.record_every:
+            self.trajectory.append(self.time, self.current_state)
+            self._unsaved_jumps = 0
 
     def SSA(self, complete_trajectory: bool =False) -> np.ndarray:
         """Computes the SSA.
@@ -168,46 +1008,588 @@ class StochasticSimulation:
               Defaults to False.
 
         Returns:
-            - **samples**: Abundance samples at the sampling times.
+            - **samples**: Abundance samples at the sampling times. Has shape :math:`(\text{n_samples}, N)`.
         """
+        lambdas = self.eval_propensities()
         while True:
-            eval_propensities = np.vectorize(lambda f, x: f(x), excluded=[1], otypes=[np.ndarray])
-            lambdas = eval_propensities(self.propensities, self.current_state)
-            lambda0 = lambdas.sum()
-            probabilities = np.cumsum(lambdas) / lambda0
-            delta = np.random.exponential(1/lambda0)
+            if self.check_caps and self._exceeds_caps():
+                self._save_last_samples(complete_trajectory)
+                break
+            # the total propensity is summed at each step rather than updated, so that rounding errors do not accumulate
+            cumulated_lambdas = np.cumsum(lambdas)
+            lambda0 = cumulated_lambdas[-1]
+            # infinite waiting time when no reaction can occur
+            delta = self.random.exponential() / lambda0 if lambda0 > 0 else np.inf
             self.time += delta
             if self.time > self.final_time:
-                if not(complete_trajectory):
-                    # last samples
-                    for _ in range(len(self.sampling_times) - len(self.samples)):
-                        self.samples.append(list(self.current_state))
-                else:
-                    if len(self.samples) == 0:
-                        self.sampling_times = np.concatenate((self.sampling_times, [self.final_time]))
-                        self.samples.append(list(self.current_state))
+                self._save_last_samples(complete_trajectory)
                 break
             # choosing which reaction occurs
-            u = random.random()
-            ind_reaction = np.searchsorted(probabilities, u, side='right') # the reaction n°ind_reaction occurs
+            u = self.random.uniform()
+            ind_reaction = np.searchsorted(cumulated_lambdas, u*lambda0, side='right') # the reaction n°ind_reaction occurs
             if not(complete_trajectory):
                 # sampling if needed
-                last_index = int(np.searchsorted(self.sampling_times, self.time - delta, side='left'))
-                current_index = int(np.searchsorted(self.sampling_times, self.time, side='left'))
-                for _ in range(current_index - last_index):
-                    self.samples.append(list(self.current_state))
+                self._save_samples(self.time)
             # updating state
             self.current_state += self.stoich_mat[:, ind_reaction]
+            self.n_events += 1
+            if complete_trajectory:
+                self._save_jump()
+            # updating the propensities affected by the reaction
+            for k in self.dependency_graph[ind_reaction]:
+                lambdas[k] = self.propensities[k](self.params, self.current_state)
+        return self.trajectory.states
+
+    def SSA_CR(self, complete_trajectory: bool =False) -> np.ndarray:
+        r"""Computes the SSA with the composition-rejection method of :cite:`slepoy2008constant` to choose the reactions.
+
+        The reactions are grouped into bins of propensities (see ``PropensityBins``), so that choosing a reaction does not
+        require to compute the cumulative sum of all propensities. Suited to networks with many reactions.
+
+        Args:
+            - **complete_trajectory** (bool): If True, returns the complete jump process, ie the time
+              of each jump and the corresponding abundance. The jump times can be found in the attribute **sampling_times**.
+              Defaults to False.
+
+        Returns:
+            - **samples**: Abundance samples at the sampling times. Has shape :math:`(\text{n_samples}, N)`.
+        """
+        bins = PropensityBins(self.eval_propensities())
+        n_steps = 0
+        while True:
+            if self.check_caps and self._exceeds_caps():
+                self._save_last_samples(complete_trajectory)
+                break
+            if bins.total <= 0 or n_steps % self.n_reactions == 0:
+                # the sums are recomputed every M reactions, which avoids the accumulation of rounding errors 
+                # in the running totals at a constant cost per reaction
+                bins.recompute()
+            n_steps += 1
+            # infinite waiting time when no reaction can occur
+            delta = self.random.exponential() / bins.total if bins.members and bins.total > 0 else np.inf
+            self.time += delta
+            if self.time > self.final_time:
+                self._save_last_samples(complete_trajectory)
+                break
+            ind_reaction = bins.select(self.random)
+            if not(complete_trajectory):
+                # sampling if needed
+                self._save_samples(self.time)
+            # updating state
+            self.current_state += self.stoich_mat[:, ind_reaction]
+            self.n_events += 1
+            if complete_trajectory:
+                self._save_jump()
+            # updating the propensities affected by the reaction
+            for k in self.dependency_graph[ind_reaction]:
+                bins.update(k, float(self.propensities[k](self.params, self.current_state)))
+        return self.trajectory.states
+
+    def mNRM(self, complete_trajectory: bool =False, clocks: PoissonClocks =None) -> np.ndarray:
+        r"""Computes the modified Next Reaction Method as defined in :cite:`anderson2007modified`.
+
+        Each reaction :math:`k` has its own internal clock :math:`T_k = \int_{t_0}^t \lambda_k(X_s)ds` and the time :math:`P_k` 
+        of its next firing in its own unit-rate Poisson process. The next reaction to occur is the one with the smallest 
+        putative time :math:`t + (P_k - T_k)/\lambda_k`, found with an indexed priority queue.
+        After each reaction, only the propensities which depend on the modified species are evaluated again.
+
+        Args:
+            - **complete_trajectory** (bool): If True, returns the complete jump process, ie the time
+              of each jump and the corresponding abundance. The jump times can be found in the attribute **sampling_times**.
+              Defaults to False.
+            - **clocks** (PoissonClocks, optional): Poisson processes of the reactions, updated in place. The same object 
+              should be used for all time windows of a trajectory. If None, the processes start at this time window and 
+              draw from the random number generator of the simulation. Defaults to None.
+
+        Returns:
+            - **samples**: Abundance samples at the sampling times. Has shape :math:`(\text{n_samples}, N)`.
+        """
+        affected = self.dependency_graph
+        lambdas = self.eval_propensities()
+        # internal times T_k, as computed at the last update of the propensity lambda_k
+        if clocks is None:
+            internal_times = np.zeros(self.n_reactions)
+            next_firings = self.random.rng.standard_exponential(self.n_reactions)
+            streams = [self.random]*self.n_reactions
+        else:
+            internal_times = clocks.internal_times
+            next_firings = clocks.next_firings
+            streams = clocks.streams
+        last_updates = np.full(self.n_reactions, float(self.time))
+        with np.errstate(divide='ignore'):
+            # infinite putative time when the propensity is zero
+            queue = IndexedPriorityQueue(self.time + (next_firings - internal_times) / lambdas)
+        while True:
+            if self.check_caps and self._exceeds_caps():
+                self._save_last_samples(complete_trajectory)
+                break
+            ind_reaction, new_time = queue.top()
+            if new_time > self.final_time:
+                self.time = self.final_time
+                self._save_last_samples(complete_trajectory)
+                # internal times at the final time, for the next time window
+                internal_times += lambdas * (self.final_time - last_updates)
+                break
+            if not(complete_trajectory):
+                # sampling if needed
+                self._save_samples(new_time)
+            # updating state
+            self.time = new_time
+            self.current_state += self.stoich_mat[:, ind_reaction]
+            self.n_events += 1
+            if complete_trajectory:
+                self._save_jump()
+            # the internal clock of the reaction which occurred reaches its next firing time
+            internal_times[ind_reaction] = next_firings[ind_reaction]
+            last_updates[ind_reaction] = new_time
+            next_firings[ind_reaction] += streams[ind_reaction].exponential()
+            for k in affected[ind_reaction]:
+                internal_times[k] += lambdas[k] * (new_time - last_updates[k])
+                last_updates[k] = new_time
+                lambdas[k] = self.propensities[k](self.params, self.current_state)
+            for k in set(affected[ind_reaction]) | {ind_reaction}:
+                if lambdas[k] > 0:
+                    queue.update(k, new_time + (next_firings[k] - internal_times[k]) / lambdas[k])
+                else:
+                    queue.update(k, np.inf)
+        return self.trajectory.states
+
+
+    def tau_leap(self, 
+                complete_trajectory: bool =False, 
+                epsilon: float =0.03, 
+                n_critical: int =10, 
+                ssa_threshold: float =10.,
+                n_ssa_steps: int =100) -> np.ndarray:
+        r"""Computes the tau-leaping method with the step size selection of :cite:`cao2006efficient`.
+
+        At each step, the number of occurrences of each reaction during the leap :math:`\tau` is drawn from a Poisson distribution. 
+        The leap is chosen so that the expected relative change of each reactant species is bounded by :math:`\varepsilon`.
+        Reactions which are less than :math:`n_{\text{critical}}` occurrences away from exhausting one of their reactants are 
+        critical: at most one of them fires during a leap. The leap is also bounded by the stiffness of the system, ie 
+        :math:`\tau \|SJ\|_\infty \leq \varepsilon` where :math:`S` is the stoichiometry matrix and :math:`J` the Jacobian of 
+        the propensities, estimated by finite differences: large leaps with respect to the relaxation time inflate the variance
+        of the abundances. The numbers of occurrences of the non-critical reactions are drawn with the propensities at the 
+        estimated midpoint of the leap :cite:`gillespie2001approximate`, which removes the first-order bias of the mean.
+        When the selected leap is shorter than a few SSA steps, ie when copy numbers are small, 
+        :math:`n_{\text{SSA}}` exact SSA steps are computed instead.
+        The leaps end at the sampling times, so that the samples are taken exactly at the sampling times.
+
+        Args:
+            - **complete_trajectory** (bool, optional): If True, returns the state after each leap. The corresponding times 
+              can be found in the attribute **sampling_times**. Defaults to False.
+            - :math:`\varepsilon` (float, optional): Error control parameter. Defaults to :math:`0.03`.
+            - :math:`n_{\text{critical}}` (int, optional): Threshold under which a reaction is critical. Defaults to :math:`10`.
+            - **ssa_threshold** (float, optional): The method switches to SSA steps when the leap is smaller than 
+              **ssa_threshold** times the mean waiting time of the SSA. Defaults to :math:`10`.
+            - :math:`n_{\text{SSA}}` (int, optional): Number of SSA steps to compute when switching to SSA. Defaults to :math:`100`.
+
+        Returns:
+            - **samples**: Abundance samples at the sampling times.
+        """
+        stoich_mat = np.asarray(self.stoich_mat)
+        reactants = self.highest_orders > 0
+        consumed = stoich_mat < 0
+        while self.time < self.final_time:
+            if self.check_caps and self._exceeds_caps():
+                break
+            # propensities at the current state and with one more molecule of each species, for the stiffness bound
+            shifted = self.vectorized_propensities(self.params, self.current_state + np.eye(self.n_species+1, self.n_species, k=-1))
+            lambdas = shifted[0]
+            lambda0 = lambdas.sum()
+            if lambda0 <= 0:
+                # no reaction can occur anymore
+                break
+            # maximal number of firings of each reaction before one of its reactants is exhausted
+            with np.errstate(divide='ignore', invalid='ignore'):
+                n_firings = np.where(consumed, np.floor(self.current_state[:, None] / np.abs(stoich_mat)), np.inf).min(axis=0)
+            critical = (n_firings < n_critical) & (lambdas > 0)
+            # step size selection, based on the non-critical reactions only
+            non_critical_lambdas = np.where(critical, 0, lambdas)
+            mu = stoich_mat.dot(non_critical_lambdas)[reactants]
+            sigma2 = (stoich_mat**2).dot(non_critical_lambdas)[reactants]
+            bounds = np.maximum(epsilon*self.current_state[reactants]/self.highest_orders[reactants], 1)
+            with np.errstate(divide='ignore'):
+                tau1 = min(np.min(bounds/np.abs(mu), initial=np.inf), np.min(bounds**2/sigma2, initial=np.inf))
+            # stiffness bound, from the Jacobian of the drift estimated by finite differences
+            jacobian = stoich_mat.dot((shifted[1:] - lambdas).T)
+            with np.errstate(divide='ignore'):
+                tau1 = min(tau1, epsilon / np.abs(jacobian).sum(axis=1).max())
+            if tau1 < ssa_threshold / lambda0:
+                self._ssa_steps(n_ssa_steps, complete_trajectory, lambdas)
+                continue
+            lambda0_critical = lambdas[critical].sum()
+            # the leaps stop at the sampling times and at the final time
+            next_stop = self._next_stop()
+            while True:
+                tau2 = self.random.exponential() / lambda0_critical if lambda0_critical > 0 else np.inf
+                fire_critical = tau2 <= tau1 and self.time + tau2 <= next_stop
+                tau = min(tau1, tau2, next_stop - self.time)
+                # estimated midpoint of the leap
+                midpoint = np.maximum(self.current_state + np.rint(stoich_mat.dot(non_critical_lambdas)*tau/2), 0)
+                midpoint_lambdas = np.where(critical, 0, self.vectorized_propensities(self.params, midpoint[None, :])[0])
+                n_occurrences = self.random.rng.poisson(midpoint_lambdas*tau)
+                if fire_critical:
+                    cumulated_lambdas = np.cumsum(np.where(critical, lambdas, 0))
+                    n_occurrences[np.searchsorted(cumulated_lambdas, self.random.uniform()*cumulated_lambdas[-1], side='right')] += 1
+                new_state = self.current_state + stoich_mat.dot(n_occurrences)
+                if (new_state >= 0).all():
+                    break
+                # negative abundances: the leap is too large
+                tau1 /= 2
+            if not(complete_trajectory):
+                # sampling if needed
+                self._save_samples(self.time + tau)
+            self.time = min(self.time + tau, next_stop)
+            self.current_state[:] = new_state
+            self.n_events += 1
+            if complete_trajectory and n_occurrences.any():
+                self._save_jump()
+        self.time = self.final_time
+        self._save_last_samples(complete_trajectory)
+        return self.trajectory.states
+
+    def _next_stop(self) -> float:
+        # next sampling time, or final time
+        next_stop = self.sampling_times[self.sampling_times > self.time]
+        return min(next_stop[0], self.final_time) if len(next_stop) > 0 else self.final_time
+
+    def CLE(self, complete_trajectory: bool =False, dt: float =0.01) -> np.ndarray:
+        r"""Integrates the Chemical Langevin Equation :cite:`gillespie2000chemical` with the Euler-Maruyama scheme:
+
+        .. math::
+
+            X_{t+h} = X_t + S\left(\lambda(X_t)h + \sqrt{\lambda(X_t)h}\odot\xi\right), \quad \xi \sim \mathcal{N}(0, I_M)
+
+        where :math:`S` is the stoichiometry matrix. The abundances are continuous and kept nonnegative. They are rounded to 
+        the nearest integers when they are sampled and at the end of the time window. The steps end at the sampling times. 
+        Suited to high abundances only.
+
+        Args:
+            - **complete_trajectory** (bool, optional): If True, returns the state after each step. The corresponding times 
+              can be found in the attribute **sampling_times**. Defaults to False.
+            - **dt** (float, optional): Time step :math:`h`. Defaults to :math:`0.01`.
+
+        Returns:
+            - **samples**: Abundance samples at the sampling times. Has shape :math:`(\text{n_samples}, N)`.
+        """
+        stoich_mat = self.stoich_mat.astype(float)
+        x = self.current_state.astype(float)
+        while self.time < self.final_time:
+            if self.check_caps and self._exceeds_caps():
+                break
+            next_stop = self._next_stop()
+            h = min(dt, next_stop - self.time)
+            lambdas = np.maximum(self.vectorized_propensities(self.params, x[None, :])[0], 0)*h
+            noise = self.random.rng.standard_normal(self.n_reactions)
+            x = np.maximum(x + stoich_mat.dot(lambdas + np.sqrt(lambdas)*noise), 0)
+            if not(complete_trajectory):
+                # sampling if needed
+                self._save_samples(self.time + h)
+            self.time = min(self.time + h, next_stop)
+            self.current_state[:] = np.rint(x)
+            self.n_events += 1
             if complete_trajectory:
-                self.sampling_times = np.concatenate((self.sampling_times, [self.time]))
-                self.samples.append(list(self.current_state))
-        return np.array(self.samples)
+                self._save_jump()
+        self._save_last_samples(complete_trajectory)
+        return self.trajectory.states
 
-    def mNRM(self, complete_trajectory=False):
-        """Computes the mNRM.
+    def hybrid(self, 
+                complete_trajectory: bool =False, 
+                dt: float =0.01, 
+                fast_threshold: float =10., 
+                abundance_threshold: float =100.,
+                n_ssa_steps: int =100) -> np.ndarray:
+        r"""Computes the hybrid method of :cite:`salis2005accurate`, which partitions the reactions at each step. 
         
-        To be implemented.
+        A reaction is fast if it is expected to occur at least :math:`n_{\text{fast}}` times during a time step and if all
+        the species it consumes have abundances of at least :math:`n_{\text{abundance}}`. Fast reactions are integrated with the 
+        Chemical Langevin Equation (see ``CLE``). Slow reactions remain discrete: the next one occurs when the integral of the 
+        total slow propensity reaches an exponential random variable, the step being shortened to end at that time.
+        When no reaction is fast, :math:`n_{\text{SSA}}` exact SSA steps are computed instead of time steps.
+        The abundances are rounded to the nearest integers when they are sampled and at the end of the time window.
+
+        Args:
+            - **complete_trajectory** (bool, optional): If True, returns the state after each step. The corresponding times 
+              can be found in the attribute **sampling_times**. Defaults to False.
+            - **dt** (float, optional): Maximal time step. Defaults to :math:`0.01`.
+            - :math:`n_{\text{fast}}` (float, optional): Expected number of occurrences during a time step from which a reaction
+              can be fast. Defaults to :math:`10`.
+            - :math:`n_{\text{abundance}}` (float, optional): Abundance from which a reactant allows a reaction to be fast. 
+              Defaults to :math:`100`.
+            - :math:`n_{\text{SSA}}` (int, optional): Number of SSA steps to compute when no reaction is fast. Defaults to :math:`100`.
+
+        Returns:
+            - **samples**: Abundance samples at the sampling times. Has shape :math:`(\text{n_samples}, N)`.
         """
-        pass
+        stoich_mat = self.stoich_mat.astype(float)
+        consumed = stoich_mat < 0
+        x = self.current_state.astype(float)
+        # integral of the slow propensity since the last slow reaction, and its value at the next slow reaction
+        slow_clock = 0.
+        next_slow = self.random.exponential()
+        while self.time < self.final_time:
+            if self.check_caps and self._exceeds_caps():
+                break
+            lambdas = np.maximum(self.vectorized_propensities(self.params, x[None, :])[0], 0)
+            lowest_reactants = np.where(consumed, x[:, None], np.inf).min(axis=0)
+            fast = (lambdas*dt >= fast_threshold) & (lowest_reactants >= abundance_threshold)
+            if not fast.any():
+                # all reactions are slow: jumps from one reaction to the next instead of stepping through time
+                self.current_state[:] = np.rint(np.maximum(x, 0))
+                self._ssa_steps(n_ssa_steps, complete_trajectory, self.eval_propensities())
+                x = self.current_state.astype(float)
+                # the waiting time of the next slow reaction is memoryless, it can be drawn again
+                slow_clock = 0.
+                next_slow = self.random.exponential()
+                continue
+            slow_lambdas = np.where(fast, 0, lambdas)
+            lambda0_slow = slow_lambdas.sum()
+            next_stop = self._next_stop()
+            h = min(dt, next_stop - self.time)
+            fire = lambda0_slow > 0 and slow_clock + lambda0_slow*h >= next_slow
+            if fire:
+                h = (next_slow - slow_clock) / lambda0_slow
+            fast_lambdas = np.where(fast, lambdas, 0)*h
+            noise = self.random.rng.standard_normal(self.n_reactions)
+            x = x + stoich_mat.dot(fast_lambdas + np.sqrt(fast_lambdas)*noise)
+            slow_clock += lambda0_slow*h
+            if not(complete_trajectory):
+                # sampling if needed
+                self._save_samples(self.time + h)
+            self.time = min(self.time + h, next_stop)
+            if fire:
+                cumulated_lambdas = np.cumsum(slow_lambdas)
+                ind_reaction = np.searchsorted(cumulated_lambdas, self.random.uniform()*cumulated_lambdas[-1], side='right')
+                x = x + stoich_mat[:, ind_reaction]
+                slow_clock = 0.
+                next_slow = self.random.exponential()
+            x = np.maximum(x, 0)
+            self.current_state[:] = np.rint(x)
+            self.n_events += 1
+            if complete_trajectory:
+                self._save_jump()
+        self._save_last_samples(complete_trajectory)
+        return self.trajectory.states
+
+    def _ssa_steps(self, n_steps: int, complete_trajectory: bool, lambdas: np.ndarray):
+        # exact SSA steps, used by tau-leaping when copy numbers are small
+        # the propensities at the current state are updated after each reaction as in `SSA`
+        lambdas = lambdas.copy()
+        for _ in range(n_steps):
+            if self.check_caps and self._exceeds_caps():
+                return
+            cumulated_lambdas = np.cumsum(lambdas)
+            lambda0 = cumulated_lambdas[-1]
+            delta = self.random.exponential() / lambda0 if lambda0 > 0 else np.inf
+            if self.time + delta > self.final_time:
+                self.time = self.final_time
+                return
+            self.time += delta
+            ind_reaction = np.searchsorted(cumulated_lambdas, self.random.uniform()*lambda0, side='right')
+            if not(complete_trajectory):
+                self._save_samples(self.time)
+            self.current_state += self.stoich_mat[:, ind_reaction]
+            self.n_events += 1
+            if complete_trajectory:
+                self._save_jump()
+            for k in self.dependency_graph[ind_reaction]:
+                lambdas[k] = self.propensities[k](self.params, self.current_state)
+
 
+class EnsembleSimulation:
+    r"""
+    Class to run many independent simulations between two time points of the same time window using the Stochastic Simulation Algorithm :cite:`gillespie1976general`.
+    All trajectories are stored in a single array and advanced in lockstep: at each iteration, the waiting times and the reactions
+    are drawn at once for all the trajectories which have not reached the final time yet.
 
+    The propensities of all trajectories are first computed with the vectorised propensity function. After each iteration, the 
+    propensity functions of the affected reactions are called with the transposed array of the states to update, of shape
+    :math:`(N, n)`, so that ``x[i]`` is the vector of abundances of the species :math:`i` for these trajectories. 
+    As in ``PropensityBundle``, propensity functions which cannot be evaluated on arrays are evaluated state by state.
+
+    Args:
+        - :math:`x_0` (np.ndarray): Initial states. Has shape :math:`(n_{\text{trajectories}}, N)`.
+        - :math:`t_0` (float): Initial time of the simulation.
+        - :math:`t_f` (float): Final time of the simulation.
+        - **sampling_times** (np.ndarray): Sampling times.
+        - **propensities** (np.ndarray): Non-parameterised propensity functions.
+        - **params** (np.ndarray): Parameters associated to the propensity functions.
+        - **vectorized_propensities** (Callable): Function computing all propensities at once, as defined in ``CRN``.
+        - **n_species** (int): Number of species involved :math:`N`.
+        - **n_reactions** (int): Number of reactions of the CRN :math:`M`.
+        - **stoich_mat** (np.ndarray): Stoichiometry matrix.
+        - **dependency_graph** (list, optional): For each reaction, indices of the reactions whose propensities have to be 
+          updated once it has occurred. If None, all propensities are updated after each reaction. Defaults to None.
+        - **rng** (np.random.Generator, optional): Random number generator. If None, a generator is created from fresh entropy.
+          Defaults to None.
+        - **max_abundances** (np.ndarray, optional): Maximal abundance of each species. Has shape :math:`(N,)`. A trajectory whose
+          abundances exceed it is stopped: its state remains the same until the end of the simulation and it is flagged as capped.
+          If None, no maximal abundance. Defaults to None.
+        - **max_events** (int, optional): Maximal number of events of a trajectory, ie of reactions, or of leaps and time steps 
+          for the approximate methods. A trajectory which reaches it is stopped and flagged in the same way. If None, no maximal 
+          number of events. Defaults to None.
+        - **n_events** (np.ndarray, optional): Number of events of each trajectory in the previous time windows. 
+          If None, zero for all trajectories. Defaults to None.
+    """
+    def __init__(self,
+                x0: np.ndarray,
+                t0: float,
+                tf: float,
+                sampling_times: np.ndarray,
+                propensities: np.ndarray,
+                params: np.ndarray,
+                vectorized_propensities: Callable,
+                n_species: int,
+                n_reactions: int,
+                stoich_mat: np.ndarray,
+                dependency_graph: list =None,
+                rng: np.random.Generator =None,
+                max_abundances: np.ndarray =None,
+                max_events: int =None,
+                n_events: np.ndarray =None):
+        self.final_time = tf
+        self.n_species = n_species
+        self.n_reactions = n_reactions
+        self.n_trajectories = np.shape(x0)[0]
+        self.time = np.full(self.n_trajectories, t0, dtype=float)
+        self.sampling_times = sampling_times
+        self.current_state = x0.copy()
+        self.propensities = propensities
+        self.params = params
+        self.vectorized_propensities = vectorized_propensities
+        # True for the propensity functions which failed on arrays, then evaluated state by state
+        self.scalar_propensities = np.zeros(n_reactions, dtype=bool)
+        # jumps as rows, to update the states with a single indexing
+        self.jumps = np.transpose(stoich_mat)
+        self.rng = np.random.default_rng() if rng is None else rng
+        # affects[j, k] is True if the reaction j modifies the propensity of the reaction k
+        self.affects = np.ones((n_reactions, n_reactions), dtype=bool)
+        if dependency_graph is not None:
+            self.affects[:] = False
+            for j, affected in enumerate(dependency_graph):
+                self.affects[j, affected] = True
+        # budgets are only checked when specified
+        self.check_caps = max_abundances is not None or max_events is not None
+        self.max_abundances = np.full(n_species, np.inf) if max_abundances is None else np.asarray(max_abundances)
+        self.max_events = np.inf if max_events is None else max_events
+        self.n_events = np.zeros(self.n_trajectories, dtype=np.int64) if n_events is None else np.array(n_events)
+        self.capped = np.zeros(self.n_trajectories, dtype=bool)
+        if self.check_caps:
+            self._exceeds_caps(np.arange(self.n_trajectories))
+
+    def _exceeds_caps(self, rows: np.ndarray) -> np.ndarray:
+        # flags the given trajectories which exceed the budgets and returns the indices of the stopped ones
+        exceeded = rows[(self.n_events[rows] >= self.max_events) | (self.current_state[rows] > self.max_abundances).any(axis=1)]
+        self.capped[exceeded] = True
+        return exceeded
+
+    def eval_propensities(self, states: np.ndarray) -> np.ndarray:
+        """Evaluates all propensity functions on several states at once.
+
+        Args:
+            - **states** (np.ndarray): States of the trajectories. Has shape :math:`(n, N)`.
+
+        Returns:
+            - The propensities of each reaction for each state. Has shape :math:`(n, M)`.
+        """
+        return self.vectorized_propensities(self.params, states)
+
+    def _update_propensity(self, k: int, states: np.ndarray) -> np.ndarray:
+        # evaluates the propensity of the reaction k on several states
+        f = self.propensities[k]
+        if not self.scalar_propensities[k]:
+            try:
+                return f(self.params, states.T)
+            except (ValueError, TypeError):
+                self.scalar_propensities[k] = True
+        return np.array([f(self.params, state) for state in states], dtype=float)
+
+    def SSA(self) -> np.ndarray:
+        """Computes the SSA for all trajectories.
+
+        Returns:
+            - **samples**: Abundance samples at the sampling times. Has shape :math:`(n_{\text{trajectories}}, \text{n_sampling_times}, N)`.
+        """
+        n_samples = len(self.sampling_times)
+        samples = np.empty((self.n_trajectories, n_samples, self.n_species))
+        # index of the next sampling time for each trajectory
+        next_sample = np.zeros(self.n_trajectories, dtype=int)
+        active = np.arange(self.n_trajectories)
+        all_lambdas = self.eval_propensities(self.current_state)
+        while len(active) > 0:
+            states = self.current_state[active]
+            # the total propensities are summed at each step rather than updated, so that rounding errors do not accumulate
+            cumulated_lambdas = np.cumsum(all_lambdas[active], axis=1)
+            lambda0 = np.maximum(cumulated_lambdas[:, -1], 0)
+            # a stopped trajectory waits until the final time with its current state
+            lambda0[self.capped[active]] = 0
+            with np.errstate(divide='ignore'):
+                # infinite waiting time when no reaction can occur
+                delta = self.rng.standard_exponential(len(active)) / lambda0
+            new_time = self.time[active] + delta
+            finished = new_time > self.final_time
+            # the states are sampled at all sampling times passed before the jump
+            last_sample = np.searchsorted(self.sampling_times, new_time, side='left')
+            last_sample[finished] = n_samples
+            to_sample = next_sample[active] < last_sample
+            while to_sample.any():
+                rows = active[to_sample]
+                samples[rows, next_sample[rows]] = states[to_sample]
+                next_sample[rows] += 1
+                to_sample = next_sample[active] < last_sample
+            # choosing which reaction occurs for the trajectories still running
+            running = ~finished
+            active = active[running]
+            cumulated_lambdas = cumulated_lambdas[running]
+            u = self.rng.random(len(active)) * cumulated_lambdas[:, -1]
+            ind_reactions = (cumulated_lambdas <= u[:, None]).sum(axis=1)
+            # updating states
+            self.time[active] = new_time[running]
+            self.current_state[active] += self.jumps[ind_reactions]
+            # updating the propensities affected by the reactions
+            to_update = self.affects[ind_reactions]
+            for k in range(self.n_reactions):
+                rows = active[to_update[:, k]]
+                if len(rows) > 0:
+                    all_lambdas[rows, k] = self._update_propensity(k, self.current_state[rows])
+            self.n_events[active] += 1
+            if self.check_caps:
+                self._exceeds_caps(active)
+        self.time[:] = self.final_time
+        return samples
+
+    def CLE(self, dt: float =0.01) -> np.ndarray:
+        r"""Integrates the Chemical Langevin Equation :cite:`gillespie2000chemical` for all trajectories with the 
+        Euler-Maruyama scheme, as in ``StochasticSimulation.CLE``. All trajectories share the same time steps, which end 
+        at the sampling times. The abundances remain continuous between time windows and are rounded when sampled.
+
+        Args:
+            - **dt** (float, optional): Time step. Defaults to :math:`0.01`.
+
+        Returns:
+            - **samples**: Abundance samples at the sampling times. Has shape :math:`(n_{\text{trajectories}}, \text{n_sampling_times}, N)`.
+        """
+        samples = np.empty((self.n_trajectories, len(self.sampling_times), self.n_species))
+        jumps = np.asarray(self.jumps, dtype=float)
+        time = self.time[0]
+        stops = list(self.sampling_times) + [self.final_time]
+        for i, stop in enumerate(stops):
+            while time < stop:
+                h = min(dt, stop - time)
+                lambdas = np.maximum(self.eval_propensities(self.current_state), 0)*h
+                noise = self.rng.standard_normal(lambdas.shape)
+                new_state = np.maximum(self.current_state + (lambdas + np.sqrt(lambdas)*noise).dot(jumps), 0)
+                if self.check_caps:
+                    # the stopped trajectories keep their states
+                    new_state[self.capped] = self.current_state[self.capped]
+                    self.n_events[~self.capped] += 1
+                    self.current_state = new_state
+                    self._exceeds_caps(np.flatnonzero(~self.capped))
+                else:
+                    self.current_state = new_state
+                time = min(time + h, stop)
+            if i < len(self.sampling_times):
+                samples[:, i] = np.rint(self.current_state)
+        self.time[:] = self.final_time
+        return samples
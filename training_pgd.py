@@ -29,7 +29,8 @@ def pgdFSP(crn: simulation.CRN,
                                           'parameters', 
                                           'gradients_losses', 
                                           'real_losses', 
-                                          'exp_results'])):
+                                          'exp_results']),
+          tol: float =None):
     r"""Performs the PGD with the FSP method, saves the selected parameters for the algorithm and the results in a ``.txt`` file,
     plots the results and saves them in CSV files.
 
@@ -62,6 +63,8 @@ def pgdFSP(crn: simulation.CRN,
         - **directory** (str, optional): Name of the directory under which to save the files. Must end with "/". Defaults to "", which means no directory.
         - **save** (Tuple[bool, list], optional): If the first argument is True, saves the file. The second argument is the name of the file under 
           which to save the plot. Defaults to (True, ["control_values", "experimental_losses", "parameters", "gradients_losses", "real_losses", "exp_results"]).
+        - **tol** (float, optional): Tolerance on the probability mass which leaves the truncated state space. If specified, the 
+          truncated state space is expanded from :math:`C_r` when needed. Defaults to None.
     """
     optimiserFSP = pgd.ProjectedGradientDescent_FSP(crn=crn,
                                                     ind_species=ind_species,
@@ -71,7 +74,8 @@ def pgdFSP(crn: simulation.CRN,
                                                     loss=loss,
                                                     grad_loss=grad_loss,
                                                     weights=weights,
-                                                    cr=cr)
+                                                    cr=cr,
+                                                    tol=tol)
     final_time, control_params, loss_value = pgd.control_method(optimiser=optimiserFSP,
                                                                 gamma=gamma,
                                                                 n_iter=n_iter,
@@ -91,6 +95,8 @@ def pgdFSP(crn: simulation.CRN,
         else:
             f.write(f'loss: {loss(0)}, {loss(1)}, {loss(2)}\n')
         f.write(f'c_r: {cr}\n')
+        if tol is not None:
+            f.write(f'tol: {tol}\n')
         f.write(f'gamma: {gamma}\n')
         f.write(f'n_iter: {n_iter}\n')
         f.write(f'targets: {targets}\n')